@@ -12,7 +12,7 @@ setup(name='TractSeg',
         packages=find_packages(),
         install_requires=[
             'future',
-            'numpy',
+            'numpy>=1.17.0',
             'nibabel>=2.3.0',
             'matplotlib',
             'sklearn',
@@ -35,7 +35,7 @@ setup(name='TractSeg',
         scripts=[
             'bin/TractSeg', 'bin/ExpRunner', 'bin/flip_peaks', 'bin/calc_FA', 'bin/Tractometry',
             'bin/download_all_pretrained_weights', 'bin/Tracking', 'bin/rotate_bvecs',
-            'bin/plot_tractometry_results'
+            'bin/plot_tractometry_results', 'bin/Tractometry_cohort'
         ],
         package_data = {'tractseg.resources': ['MNI_FA_template.nii.gz',
                                       'random_forest_peak_orientation_detection.pkl']},
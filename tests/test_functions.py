@@ -3,9 +3,30 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import copy
+import shutil
+import tempfile
+import threading
 import unittest
+from unittest import mock
+import numpy as np
+import nibabel as nib
 
 from tractseg.data import dataset_specific_utils
+from tractseg.libs import tractseg_prob_tracking
+from tractseg.libs import fiber_utils
+from tractseg.libs import data_utils
+from tractseg.libs import img_utils
+from tractseg.libs import peak_utils
+from tractseg.libs import metric_utils
+from tractseg.libs import pytorch_utils
+from tractseg.libs import tractometry
+from tractseg.libs.system_config import SystemConfig
+from tractseg.data import data_loader_training
+from tractseg.experiments.base import Config as BaseConfig
+from tractseg.data import spatial_transform_peaks
+from tractseg.data import torch_augmentation
 
 
 class test_functions(unittest.TestCase):
@@ -17,5 +38,294 @@ class test_functions(unittest.TestCase):
         bundles = dataset_specific_utils.get_bundle_names("CST_right")
         self.assertListEqual(bundles, ["BG", "CST_right"], "Error in list of bundle names")
 
+    def test_prob_tracking_reproducible(self):
+        def track(nr_cpus, seed):
+            peaks = np.zeros((8, 20, 8, 3), dtype=np.float32)
+            peaks[:, :, :, 1] = 1
+            bundle_mask = np.zeros((8, 20, 8), dtype=np.uint8)
+            bundle_mask[2:6, 1:19, 2:6] = 1
+            start_mask = np.zeros_like(bundle_mask)
+            start_mask[2:6, 1:3, 2:6] = 1
+            end_mask = np.zeros_like(bundle_mask)
+            end_mask[2:6, 17:19, 2:6] = 1
+            return tractseg_prob_tracking.track(peaks, max_nr_fibers=10, smooth=None, compress=None,
+                                                bundle_mask=bundle_mask, start_mask=start_mask, end_mask=end_mask,
+                                                nr_cpus=nr_cpus, affine=np.diag([-5., 5., 5., 1.]), spacing=5.,
+                                                seed=seed, verbose=False)
+
+        streamlines_1 = track(1, seed=42)
+        streamlines_2 = track(2, seed=42)
+        self.assertEqual(len(streamlines_1), len(streamlines_2))
+        for sl_1, sl_2 in zip(streamlines_1, streamlines_2):
+            self.assertTrue(np.array_equal(sl_1, sl_2), "Tracking not reproducible")
+
+    def test_streamline_flat_operations(self):
+        streamlines = [np.array([[0., 0., 0.], [0., 3., 4.]]),
+                       np.array([[1., 1., 1.], [1., 1., 2.], [1., 1., 4.]])]
+        # Direct access of the nibabel internals and fallback to the public API
+        for flat_layout in [fiber_utils._FLAT_LAYOUT, False]:
+            with mock.patch.object(fiber_utils, "_FLAT_LAYOUT", flat_layout):
+                streamlines_offset = fiber_utils.add_to_each_streamline(streamlines, 0.5)
+                self.assertTrue(np.array_equal(streamlines_offset[1], streamlines[1] + 0.5))
+                streamlines_flipped = fiber_utils.flip(streamlines_offset[::-1], axis="y")
+                self.assertTrue(np.array_equal(streamlines_flipped[1], [[0.5, -0.5, 0.5], [0.5, -3.5, 4.5]]))
+                lengths, spaces = fiber_utils.get_streamline_statistics(streamlines, raw=True)
+                self.assertTrue(np.allclose(lengths, [5., 3.]))
+                self.assertTrue(np.allclose(spaces, [5., 1., 2.]))
+
+    def test_peaks2fixel(self):
+        peaks = np.zeros((2, 2, 1, 3), dtype=np.float32)
+        peaks[0, 0, 0] = [3., 0., 4.]
+        peaks[1, 1, 0] = [0., -2., 0.]
+        affine = np.diag([1.25, 1.25, 1.25, 1.])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            nib.save(nib.Nifti1Image(peaks, affine), os.path.join(tmp_dir, "peaks.nii.gz"))
+            img_utils.peaks2fixel(os.path.join(tmp_dir, "peaks.nii.gz"), os.path.join(tmp_dir, "fixel"))
+            index = nib.load(os.path.join(tmp_dir, "fixel", "index.nii.gz"))
+            directions = nib.load(os.path.join(tmp_dir, "fixel", "directions.nii.gz")).get_fdata()
+            amplitudes = nib.load(os.path.join(tmp_dir, "fixel", "amplitudes.nii.gz")).get_fdata()
+            # Voxels without peak get no fixel, the others are numbered in C order
+            index_expected = np.zeros((2, 2, 1, 2))
+            index_expected[0, 0, 0] = [1, 0]
+            index_expected[1, 1, 0] = [1, 1]
+            self.assertTrue(np.array_equal(index.get_fdata(), index_expected), "Error in fixel index")
+            self.assertTrue(np.allclose(index.affine, affine))
+            self.assertTrue(np.allclose(directions, [[0.6, 0., 0.8], [0., -1., 0.]]), "Error in fixel directions")
+            self.assertTrue(np.allclose(amplitudes, [5., 2.]), "Error in fixel amplitudes")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_streamline_io(self):
+        streamlines = [np.array([[10., 20., 30.], [12., 21., 33.]], dtype=np.float32),
+                       np.array([[-5., 0., 8.], [-4., 1., 9.], [-3., 2., 10.]], dtype=np.float32)]
+        affine = np.array([[-1.25, 0., 0., 90.], [0., 1.25, 0., -126.], [0., 0., 1.25, -72.], [0., 0., 0., 1.]])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for file_ending in ["trk", "tck"]:
+                out_file = os.path.join(tmp_dir, "bundle." + file_ending)
+                fiber_utils.save_streamlines(out_file, streamlines, affine, [145, 174, 145])
+                streamlines_loaded = fiber_utils.load_streamlines(out_file, tracking_format=file_ending)
+                self.assertEqual(len(streamlines_loaded), len(streamlines))
+                for sl, sl_loaded in zip(streamlines, streamlines_loaded):
+                    self.assertTrue(np.allclose(sl, sl_loaded, atol=1e-4), "Error in {} io".format(file_ending))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_tractometry_several_clusters(self):
+        # Two groups of streamlines more than 100 voxels apart -> QuickBundles returns two centroids
+        streamlines = [np.array([[x, y, 5.] for y in np.linspace(1, 8, 20)]) for x in [2., 2.5, 3., 115., 116.]]
+        beginnings = np.zeros((120, 10, 10), dtype=np.uint8)
+        beginnings[:, 1, 5] = 1
+        scalar_img = np.tile(np.arange(10, dtype=np.float32)[None, :, None], (120, 1, 10))  # value = y coordinate
+        mean, std = tractometry.evaluate_along_streamlines(scalar_img, streamlines, beginnings, 8, affine=np.eye(4))
+        self.assertTrue(np.allclose(mean, np.arange(1, 9)), "Error in tractometry with several clusters")
+        self.assertTrue(np.allclose(std, 0))
+
+    def _create_training_subjects(self, data_path, subjects):
+        """
+        Write small random training subjects to data_path and return a config for loading them.
+        """
+        for subject in subjects:
+            os.makedirs(os.path.join(data_path, "dataset", subject))
+            peaks = np.random.rand(16, 16, 16, 9).astype(np.float32)
+            bundle_masks = (np.random.rand(16, 16, 16, 4) > 0.5).astype(np.uint8)
+            nib.save(nib.Nifti1Image(peaks, np.eye(4)), os.path.join(data_path, "dataset", subject, "peaks.nii.gz"))
+            nib.save(nib.Nifti1Image(bundle_masks, np.eye(4)),
+                     os.path.join(data_path, "dataset", subject, "bundle_masks.nii.gz"))
+
+        class Config(BaseConfig):
+            DATASET_FOLDER = "dataset"
+            FEATURES_FILENAME = "peaks"
+            LABELS_FILENAME = "bundle_masks"
+            NR_OF_CLASSES = 4
+            INPUT_DIM = (16, 16)
+            BATCH_SIZE = 4
+        return Config
+
+    def test_subject_pool(self):
+        np.random.seed(0)
+        tmp_dir = tempfile.mkdtemp()
+        data_path = SystemConfig.DATA_PATH
+        try:
+            SystemConfig.DATA_PATH = tmp_dir
+            Config = self._create_training_subjects(tmp_dir, ["s1", "s2", "s3"])
+            Config.SUBJECT_POOL_SIZE = 2
+            Config.SUBJECT_CACHE_SIZE = 1
+            Config.SLICE_LAYOUT = True
+            batch_gen = data_loader_training.BatchGenerator2D_Nifti_random((["s1", "s2", "s3"], []), batch_size=4)
+            batch_gen.Config = Config
+            for i in range(5):
+                batch = batch_gen.generate_train_batch()
+                self.assertEqual(batch["data"].shape, (4, 9, 16, 16))
+                self.assertEqual(batch["seg"].shape, (4, 4, 16, 16))
+            loading_thread = batch_gen._loading_thread
+            batch_gen.stop()
+            self.assertFalse(loading_thread.is_alive(), "Loading thread not stopped")
+
+            # Error while loading a subject has to be raised instead of waiting for the subject forever
+            batch_gen = data_loader_training.BatchGenerator2D_Nifti_random((["missing"], []), batch_size=4)
+            batch_gen.Config = Config
+            with self.assertRaises(Exception):
+                batch_gen.generate_train_batch()
+            batch_gen.stop()
+        finally:
+            SystemConfig.DATA_PATH = data_path
+            shutil.rmtree(tmp_dir)
+
+    def test_calibrate_num_processes(self):
+        import torch
+        from tractseg.models.base_model import BaseModel
+        np.random.seed(0)
+        tmp_dir = tempfile.mkdtemp()
+        data_path = SystemConfig.DATA_PATH
+        try:
+            SystemConfig.DATA_PATH = tmp_dir
+            Config = self._create_training_subjects(tmp_dir, ["s1", "s2"])
+            Config.EXP_PATH = tmp_dir
+            Config.UNET_NR_FILT = 4
+            Config.FP16 = False
+            Config.SUBJECT_POOL_SIZE = 2
+            model = BaseModel(Config)
+            net_state = copy.deepcopy(model.net.state_dict())
+            threads = threading.enumerate()
+
+            data_loader = data_loader_training.DataLoaderTraining(Config)
+            data_loader.calibrate_num_processes(model, ["s1", "s2"], nr_batches=2)
+            self.assertGreaterEqual(data_loader.num_processes, 1)
+            self.assertIn(data_loader.num_cached_per_queue, [1, 2])
+            self.assertEqual(threading.enumerate(), threads, "Subject loading thread still running")
+            for key, value in model.net.state_dict().items():
+                self.assertTrue(torch.equal(value, net_state[key]), "Weights not restored")
+
+            # The calibrated nr of processes is only used for the train pipeline (as calibrated on a machine with
+            # more CPUs)
+            data_loader.num_processes = 7
+            data_loader.num_cached_per_queue = 2
+            batch_gen_train = data_loader.get_batch_generator(batch_size=4, type="train", subjects=["s1", "s2"])
+            batch_gen_val = data_loader.get_batch_generator(batch_size=4, type="validate", subjects=["s1", "s2"])
+            self.assertEqual(batch_gen_train.num_processes, 7)
+            self.assertEqual(batch_gen_train.num_cached_per_queue, 2)
+            self.assertEqual(batch_gen_val.num_processes, 2)
+            self.assertEqual(batch_gen_val.num_cached_per_queue, 1)
+        finally:
+            SystemConfig.DATA_PATH = data_path
+            shutil.rmtree(tmp_dir)
+
+    def test_slice_files(self):
+        np.random.seed(0)
+        data = np.random.rand(10, 12, 8, 9).astype(np.float32)
+        seg = (np.random.rand(10, 12, 8, 11) > 0.5).astype(np.uint8)
+        slice_idxs = np.array([5, 1, 2])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            data_utils.save_as_slices(data, os.path.join(tmp_dir, "peaks"))
+            data_utils.save_as_slices(seg, os.path.join(tmp_dir, "bundle_masks"))
+            for slice_direction in range(3):
+                x, y = data_utils.sample_slices(data, seg, slice_idxs, slice_direction=slice_direction,
+                                                labels_type=np.uint8)
+                x_loaded = data_utils.load_slices(os.path.join(tmp_dir, "peaks"), slice_idxs, slice_direction)
+                y_loaded = data_utils.load_slices(os.path.join(tmp_dir, "bundle_masks"), slice_idxs, slice_direction)
+                self.assertTrue(np.array_equal(x, x_loaded), "Error in loading data slices")
+                self.assertTrue(np.array_equal(y, y_loaded), "Error in loading bit-packed label slices")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_peak_rotation(self):
+        np.random.seed(0)
+        peaks = np.random.rand(4, 9, 5, 6).astype(np.float32)  # (bs, 9, x, y)
+        rot_matrices = spatial_transform_peaks.get_rotation_matrices(np.array([0., 0.3, 0., np.pi / 2]),
+                                                                     np.array([0., 0., -0.2, 0.]),
+                                                                     np.array([0., 0.1, 0., 0.]))
+        peaks_rot = spatial_transform_peaks.rotate_multiple_peaks(peaks, rot_matrices)
+        self.assertTrue(np.allclose(peaks_rot[0], peaks[0]), "Error in rotation by angle 0")
+        self.assertTrue(np.allclose(peaks_rot[3, [0, 1, 2]], [peaks[3, 0], -peaks[3, 2], peaks[3, 1]], atol=1e-6),
+                        "Error in rotation by 90 degree around x")
+
+        # Rotating tensors has to give the same as rotating the peaks and then converting them to tensors
+        tensors = peak_utils.peaks_to_tensors(peaks.transpose(0, 2, 3, 1)).transpose(0, 3, 1, 2)
+        tensors_rot = spatial_transform_peaks.rotate_multiple_tensors(tensors, rot_matrices)
+        tensors_of_rot_peaks = peak_utils.peaks_to_tensors(peaks_rot.transpose(0, 2, 3, 1)).transpose(0, 3, 1, 2)
+        self.assertTrue(np.allclose(tensors_rot, tensors_of_rot_peaks, atol=1e-6), "Error in tensor rotation")
+
+    def test_torch_peak_rotation(self):
+        import torch
+        np.random.seed(0)
+        angles = np.array([0.3, -0.1])
+        for nr_channels in [9, 18]:
+            data = np.random.rand(2, nr_channels, 5, 6).astype(np.float32)
+            for slice_dir in range(3):
+                angles_xyz = [np.zeros(2), np.zeros(2), np.zeros(2)]
+                angles_xyz[slice_dir] = angles
+                rot_matrices = spatial_transform_peaks.get_rotation_matrices(*angles_xyz)
+                if nr_channels == 9:
+                    data_rot = spatial_transform_peaks.rotate_multiple_peaks(data, rot_matrices)
+                else:
+                    data_rot = spatial_transform_peaks.rotate_multiple_tensors(data, rot_matrices)
+                rot_matrices_torch = torch_augmentation.get_rotation_matrices(torch.tensor(angles), slice_dir)
+                data_rot_torch = torch_augmentation.rotate_peaks(torch.tensor(data, dtype=torch.float64),
+                                                                 rot_matrices_torch)
+                self.assertTrue(np.allclose(data_rot, data_rot_torch.numpy()), "Error in torch peak rotation")
+
+    def test_torch_augmentation(self):
+        import torch
+
+        class Config(BaseConfig):
+            INPUT_DIM = (32, 32)
+            DAUG_ROTATE = True
+            SPATIAL_TRANSFORM = "SpatialTransformPeaks"
+
+        torch.manual_seed(0)
+        x = torch.rand((3, 9, 32, 32))
+        y = (torch.rand((3, 4, 32, 32)) > 0.5).float()
+        for slice_dir in range(3):
+            x_aug, y_aug = torch_augmentation.TorchAugmentation(Config)(x, y, slice_dir=slice_dir)
+            self.assertEqual(x_aug.shape, x.shape)
+            self.assertEqual(y_aug.shape, y.shape)
+            self.assertTrue(torch.isfinite(x_aug).all())
+            self.assertFalse(torch.equal(x_aug, x))
+            self.assertTrue(((y_aug == 0) | (y_aug == 1)).all(), "Labels not binary after augmentation")
+        with self.assertRaises(ValueError):
+            torch_augmentation.TorchAugmentation(Config)(x, y)  # slice_dir needed for rotating peaks
+
+    def test_torch_augmentation_only_2D(self):
+        from tractseg.models.base_model import BaseModel
+        from tractseg.data.spatial_transform_peaks import SpatialTransformPeaks
+
+        for dim in ["2D", "3D"]:
+            class Config(BaseConfig):
+                DIM = dim
+                DAUG_TORCH = True
+                SPATIAL_TRANSFORM = "SpatialTransformPeaks"
+                INPUT_DIM = (32, 32)
+                UNET_NR_FILT = 4
+                FP16 = False
+            model = BaseModel(Config)
+            transforms = data_loader_training.DataLoaderTraining(Config)._get_transforms(type="train").transforms
+            spatial_transform_on_cpu = any(isinstance(tf, SpatialTransformPeaks) for tf in transforms)
+            # Not implemented for 3D -> augmentation on the CPU
+            self.assertEqual(model.augmentation is not None, dim == "2D")
+            self.assertEqual(spatial_transform_on_cpu, dim == "3D")
+
+    def test_metrics_pytorch(self):
+        import torch
+        from sklearn.metrics import f1_score
+        np.random.seed(0)
+        y_true = np.random.rand(2, 5, 6, 7) > 0.5
+        y_pred = np.random.rand(2, 5, 6, 7)
+        f1s = pytorch_utils.f1_score_macro(torch.tensor(y_true), torch.tensor(y_pred), per_class=True)
+        f1s_sklearn = [f1_score(y_true[:, i].flatten(), y_pred[:, i].flatten() > 0.5) for i in range(5)]
+        self.assertTrue(np.allclose(f1s, f1s_sklearn), "Error in f1_score_macro")
+
+        y_true = np.random.randn(2, 72 * 3, 6, 7) * (np.random.rand(2, 72 * 3, 6, 7) > 0.3)
+        y_pred = y_true + 0.1 * np.random.randn(2, 72 * 3, 6, 7)
+        f1s = metric_utils.calc_peak_length_dice_pytorch("All", torch.tensor(y_pred), torch.tensor(y_true))
+        f1s_numpy = metric_utils.calc_peak_length_dice("All", y_pred.transpose(0, 2, 3, 1),
+                                                       y_true.transpose(0, 2, 3, 1))
+        self.assertEqual(list(f1s.keys()), list(f1s_numpy.keys()))
+        self.assertTrue(np.allclose(list(f1s.values()), list(f1s_numpy.values()), atol=1e-5),
+                        "Error in calc_peak_length_dice_pytorch")
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
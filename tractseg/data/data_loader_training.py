@@ -10,7 +10,12 @@ from __future__ import division
 from __future__ import print_function
 
 from os.path import join
+from collections import OrderedDict
+import copy
+import time
 import random
+import threading
+import queue
 
 import numpy as np
 import nibabel as nib
@@ -41,23 +46,30 @@ from tractseg.data.spatial_transform_custom import SpatialTransformCustom
 from tractseg.libs.system_config import SystemConfig as C
 from tractseg.libs import data_utils
 from tractseg.libs import peak_utils
+from tractseg.libs import exp_utils
 
 
-def load_training_data(Config, subject):
+def load_training_data(Config, subject, slice_idxs=None, slice_direction=0):
     """
     Load data and labels for one subject from the training set. Cut and scale to make them have
     correct size.
 
+    If slice_idxs is given, only these slices are loaded from the files created by
+    tractseg/data/preprocessing.py:create_slice_files() instead of loading the entire nifti images.
+
     Args:
         Config: config class
         subject: subject id (string)
+        slice_idxs: indices of slices to load (only for Config.TRAINING_DATA_FORMAT == "npy_slices")
+        slice_direction: direction of slice_idxs: 0|1|2
 
     Returns:
-        data and labels as 3D array
+        data and labels as 3D array (if slice_idxs is given: [len(slice_idxs), a, b, channels])
     """
     def load(filepath):
+        if slice_idxs is not None:
+            return data_utils.load_slices(filepath, slice_idxs, slice_direction).transpose(0, 2, 3, 1)
         data = nib.load(filepath + ".nii.gz").get_data()
-        # data = np.load(filepath + ".npy", mmap_mode="r")
         return data
 
     if Config.FEATURES_FILENAME == "12g90g270g":
@@ -192,6 +204,43 @@ def load_training_data(Config, subject):
     return data, seg
 
 
+class SubjectCache(object):
+    """
+    LRU cache for the data and labels of training subjects. Bounded by the memory (in MB) the cached arrays
+    occupy. Each augmentation worker has its own copy of the batch generator and therefore its own cache.
+    """
+    def __init__(self, max_size_mb=0):
+        self.max_size = max_size_mb * 1024 ** 2
+        self.size = 0
+        self._items = OrderedDict()
+
+    @staticmethod
+    def _nbytes(item):
+        return sum(data.nbytes + seg.nbytes for data, seg in item.values())
+
+    def get(self, subject):
+        if subject not in self._items:
+            return None
+        item = self._items.pop(subject)
+        self._items[subject] = item  # mark as most recently used
+        return item
+
+    def put(self, subject, item):
+        """
+        Args:
+            subject: subject id (string)
+            item: dict of (data, seg) tuples
+        """
+        if subject in self._items:
+            self.size -= self._nbytes(self._items.pop(subject))
+        self._items[subject] = item
+        self.size += self._nbytes(item)
+        # Always keep the newest subject, even if it alone exceeds the budget
+        while self.size > self.max_size and len(self._items) > 1:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= self._nbytes(evicted)
+
+
 class BatchGenerator2D_Nifti_random(SlimDataLoaderBase):
     """
     Randomly selects subjects and slices and creates batch of 2D slices.
@@ -199,12 +248,128 @@ class BatchGenerator2D_Nifti_random(SlimDataLoaderBase):
     Takes image IDs provided via self._data, randomly selects one ID,
     loads the nifti image and randomly samples 2D slices from it.
 
+    The selected subject is used for Config.NR_BATCHES_PER_SUBJECT batches before a new one is selected.
+    If Config.SUBJECT_POOL_SIZE > 0 the slices of each batch are instead sampled from a rolling pool of subjects
+    which is filled by a background thread.
+    Loaded subjects are kept in a LRU cache of Config.SUBJECT_CACHE_SIZE MB, so they do not have to be
+    decompressed again if they are selected again later.
+    If Config.SLICE_LAYOUT the subjects are kept as one contiguous copy per training slice direction
+    (see data_utils.to_slice_layout), so sampling slices does not need strided reads or transposes.
+
     Timing:
     About 2s per 54-batch 45 bundles 1.25mm.
     """
     def __init__(self, *args, **kwargs):
         super(self.__class__, self).__init__(*args, **kwargs)
         self.Config = None
+        self._cache = None
+        self._subject = None
+        self._nr_batches_left = 0
+        self._pool = None
+        self._loaded_subjects = None
+        self._stop_loading = None
+        self._loading_thread = None
+
+    def _load_subject(self, subject):
+        """
+        Returns dict with data and labels of subject: {"volume": (data, seg)} or, if Config.SLICE_LAYOUT,
+        {slice_direction: (data, seg)} for each training slice direction.
+        """
+        if self._cache is None:
+            self._cache = SubjectCache(self.Config.SUBJECT_CACHE_SIZE)
+
+        item = self._cache.get(subject)
+        if item is None:
+            data, seg = load_training_data(self.Config, subject)
+
+            # Convert peaks to tensors if tensor model
+            if self.Config.NR_OF_GRADIENTS == 18*self.Config.NR_SLICES:
+                data = peak_utils.peaks_to_tensors(data)
+
+            if self.Config.SLICE_LAYOUT:
+                if self.Config.TRAINING_SLICE_DIRECTION == "xyz":
+                    slice_directions = [0, 1, 2]
+                else:
+                    slice_directions = [data_utils.slice_dir_to_int(self.Config.TRAINING_SLICE_DIRECTION)]
+                item = {direction: (data_utils.to_slice_layout(data, direction),
+                                    data_utils.to_slice_layout(seg, direction))
+                        for direction in slice_directions}
+            else:
+                item = {"volume": (data, seg)}
+            self._cache.put(subject, item)
+        return item
+
+    def _get_subject_data(self, slice_direction):
+        """
+        Returns data and labels of the current subject. In slice layout for slice_direction if
+        Config.SLICE_LAYOUT.
+        """
+        if self._nr_batches_left <= 0:
+            subjects = self._data[0]
+            self._subject = subjects[int(random.uniform(0, len(subjects)))]
+            self._nr_batches_left = self.Config.NR_BATCHES_PER_SUBJECT
+        self._nr_batches_left -= 1
+
+        item = self._load_subject(self._subject)
+        return item[slice_direction] if self.Config.SLICE_LAYOUT else item["volume"]
+
+    def _update_pool(self):
+        """
+        Keep a rolling pool of Config.SUBJECT_POOL_SIZE subjects. New subjects are loaded by a background thread
+        and replace the oldest subject of the pool as soon as they are loaded.
+        The thread is started on the first call, so it runs inside of the augmentation worker process.
+        If loading a subject fails the exception is passed on by the thread and raised here.
+        """
+        if self._pool is None:
+            self._pool = []
+            self._loaded_subjects = queue.Queue(maxsize=1)
+            self._stop_loading = threading.Event()
+
+            def put(item):
+                while not self._stop_loading.is_set():
+                    try:
+                        self._loaded_subjects.put(item, timeout=0.1)
+                        return
+                    except queue.Full:
+                        pass
+
+            def load_subjects():
+                subjects = self._data[0]
+                while not self._stop_loading.is_set():
+                    subject = subjects[int(random.uniform(0, len(subjects)))]
+                    try:
+                        item = self._load_subject(subject)
+                    except Exception as e:
+                        put(e)
+                        return
+                    put(item)
+
+            self._loading_thread = threading.Thread(target=load_subjects)
+            self._loading_thread.daemon = True
+            self._loading_thread.start()
+
+        # Only wait for the first subject; afterwards the pool is updated without blocking
+        try:
+            item = self._loaded_subjects.get(block=len(self._pool) == 0)
+        except queue.Empty:
+            return
+        if isinstance(item, Exception):
+            raise item
+        self._pool.append(item)
+        if len(self._pool) > self.Config.SUBJECT_POOL_SIZE:
+            self._pool.pop(0)
+
+    def stop(self):
+        """
+        Stop the thread loading subjects for the pool and free the pool and the cache.
+        """
+        if self._loading_thread is not None:
+            self._stop_loading.set()
+            self._loading_thread.join()
+            self._loading_thread = None
+        self._pool = None
+        self._loaded_subjects = None
+        self._cache = None
 
     def _zoom_x_and_y(self, x, y, zoom_factor):
         # Very slow
@@ -216,30 +381,23 @@ class BatchGenerator2D_Nifti_random(SlimDataLoaderBase):
             y_new.append(y_tmp)
         return np.array(x_new), np.array(y_new)
 
-    def generate_train_batch(self):
-
-        subjects = self._data[0]
-        subject_idx = int(random.uniform(0, len(subjects)))
+    def _sample_batch(self, data, seg, batch_size, slice_direction):
 
-        data, seg = load_training_data(self.Config, subjects[subject_idx])
-
-        # Convert peaks to tensors if tensor model
-        if self.Config.NR_OF_GRADIENTS == 18*self.Config.NR_SLICES:
-            data = peak_utils.peaks_to_tensors(data)
-
-        slice_direction = data_utils.slice_dir_to_int(self.Config.TRAINING_SLICE_DIRECTION)
-        if data.shape[slice_direction] <= self.batch_size:
+        nr_slices = data.shape[0] if self.Config.SLICE_LAYOUT else data.shape[slice_direction]
+        if nr_slices <= batch_size:
             print("INFO: Batch size bigger than nr of slices. Therefore sampling with replacement.")
-            slice_idxs = np.random.choice(data.shape[slice_direction], self.batch_size, True, None)
+            slice_idxs = np.random.choice(nr_slices, batch_size, True, None)
         else:
-            slice_idxs = np.random.choice(data.shape[slice_direction], self.batch_size, False, None)
+            slice_idxs = np.random.choice(nr_slices, batch_size, False, None)
 
         if self.Config.NR_SLICES > 1:
             x, y = data_utils.sample_Xslices(data, seg, slice_idxs, slice_direction=slice_direction,
-                                             labels_type=self.Config.LABELS_TYPE, slice_window=self.Config.NR_SLICES)
+                                             labels_type=self.Config.LABELS_TYPE, slice_window=self.Config.NR_SLICES,
+                                             slice_layout=self.Config.SLICE_LAYOUT)
         else:
             x, y = data_utils.sample_slices(data, seg, slice_idxs, slice_direction=slice_direction,
-                                            labels_type=self.Config.LABELS_TYPE)
+                                            labels_type=self.Config.LABELS_TYPE,
+                                            slice_layout=self.Config.SLICE_LAYOUT)
 
 
         # Can be replaced by crop
@@ -262,18 +420,109 @@ class BatchGenerator2D_Nifti_random(SlimDataLoaderBase):
             x = pad_nd_image(x, shape_must_be_divisible_by=(16, 16), mode='constant', kwargs={'constant_values': 0})
             y = pad_nd_image(y, shape_must_be_divisible_by=(16, 16), mode='constant', kwargs={'constant_values': 0})
 
+        return x, y
+
+    def generate_train_batch(self):
+
+        slice_direction = data_utils.slice_dir_to_int(self.Config.TRAINING_SLICE_DIRECTION)
+
+        if self.Config.SUBJECT_POOL_SIZE > 0:
+            # Sample slices from different subjects and pad all to same size (size of biggest)
+            self._update_pool()
+            pool_idxs = np.random.randint(len(self._pool), size=self.batch_size)
+            x_all = []
+            y_all = []
+            for pool_idx in np.unique(pool_idxs):
+                item = self._pool[pool_idx]
+                data, seg = item[slice_direction] if self.Config.SLICE_LAYOUT else item["volume"]
+                x, y = self._sample_batch(data, seg, int((pool_idxs == pool_idx).sum()), slice_direction)
+                x_all.append(x)
+                y_all.append(y)
+            max_shape = tuple(np.max([x.shape[2:] for x in x_all + y_all], axis=0))
+            x = np.concatenate([pad_nd_image(x, max_shape, mode='constant', kwargs={'constant_values': 0})
+                                for x in x_all])
+            y = np.concatenate([pad_nd_image(y, max_shape, mode='constant', kwargs={'constant_values': 0})
+                                for y in y_all])
+        else:
+            data, seg = self._get_subject_data(slice_direction)
+            x, y = self._sample_batch(data, seg, self.batch_size, slice_direction)
+
         # Does not make it slower
         x = x.astype(np.float32)
         y = y.astype(np.float32)
 
-        # possible optimization: sample slices from different patients and pad all to same size (size of biggest)
-
         data_dict = {"data": x,  # (batch_size, channels, x, y, [z])
                      "seg": y,
                      "slice_dir": slice_direction}  # (batch_size, channels, x, y, [z])
         return data_dict
 
 
+class BatchGenerator2D_Npy_slices_random(SlimDataLoaderBase):
+    """
+    Randomly selects subjects and slices and creates batch of 2D slices.
+
+    Takes image IDs provided via self._data, randomly selects one ID and loads only the sampled
+    slices from the memory mapped npy files created by tractseg/data/preprocessing.py:create_slice_files().
+    """
+    def __init__(self, *args, **kwargs):
+        super(self.__class__, self).__init__(*args, **kwargs)
+        self.Config = None
+
+    def generate_train_batch(self):
+
+        subjects = self._data[0]
+        subject_idx = int(random.uniform(0, len(subjects)))
+
+        labels_path = join(C.DATA_PATH, self.Config.DATASET_FOLDER, subjects[subject_idx],
+                           self.Config.LABELS_FILENAME.split("|")[0])
+        nr_slices_all = data_utils.load_slices_meta(labels_path)["shape"]
+
+        slice_direction = data_utils.slice_dir_to_int(self.Config.TRAINING_SLICE_DIRECTION)
+        nr_slices = nr_slices_all[slice_direction]
+        if nr_slices <= self.batch_size:
+            print("INFO: Batch size bigger than nr of slices. Therefore sampling with replacement.")
+            slice_idxs = np.random.choice(nr_slices, self.batch_size, True, None)
+        else:
+            slice_idxs = np.random.choice(nr_slices, self.batch_size, False, None)
+        slice_idxs = np.sort(slice_idxs)  # sequential reads
+
+        if self.Config.NR_SLICES > 1:
+            # Load neighbouring slices as well; slices outside of the image are set to 0
+            pad = int((self.Config.NR_SLICES - 1) / 2)
+            window_idxs = slice_idxs[:, None] + np.arange(-pad, pad + 1)[None, :]  # [bs, nr_slices]
+            outside = (window_idxs < 0) | (window_idxs >= nr_slices)
+            data, seg = load_training_data(self.Config, subjects[subject_idx],
+                                           slice_idxs=np.clip(window_idxs, 0, nr_slices - 1).ravel(),
+                                           slice_direction=slice_direction)
+            data[outside.ravel()] = 0
+            seg = seg[pad::self.Config.NR_SLICES]  # labels only for the center slices
+        else:
+            data, seg = load_training_data(self.Config, subjects[subject_idx], slice_idxs=slice_idxs,
+                                           slice_direction=slice_direction)
+
+        # Convert peaks to tensors if tensor model
+        if self.Config.NR_OF_GRADIENTS == 18*self.Config.NR_SLICES:
+            data = peak_utils.peaks_to_tensors(data)
+
+        x = data.transpose(0, 3, 1, 2)  # (bs*nr_slices, channels, a, b)
+        x = x.reshape((len(slice_idxs), -1) + x.shape[2:])  # (bs, nr_slices*channels, a, b)
+        y = seg.transpose(0, 3, 1, 2).astype(self.Config.LABELS_TYPE)
+
+        if self.Config.PAD_TO_SQUARE:
+            x, y = crop(x, y, crop_size=self.Config.INPUT_DIM)
+        else:
+            x = pad_nd_image(x, shape_must_be_divisible_by=(16, 16), mode='constant', kwargs={'constant_values': 0})
+            y = pad_nd_image(y, shape_must_be_divisible_by=(16, 16), mode='constant', kwargs={'constant_values': 0})
+
+        x = x.astype(np.float32)
+        y = y.astype(np.float32)
+
+        data_dict = {"data": x,  # (batch_size, channels, x, y, [z])
+                     "seg": y,
+                     "slice_dir": slice_direction}
+        return data_dict
+
+
 class BatchGenerator2D_Npy_random(SlimDataLoaderBase):
     """
     Takes image ID provided via self._data, loads the Npy (numpy array) image and randomly samples 2D slices from it.
@@ -325,14 +574,61 @@ class DataLoaderTraining:
 
     def __init__(self, Config):
         self.Config = Config
-
-    def _augment_data(self, batch_generator, type=None):
-
-        if self.Config.DATA_AUGMENTATION:
-            num_processes = 15  # 15 is a bit faster than 8 on cluster
-            # num_processes = multiprocessing.cpu_count()  # on cluster: gives all cores, not only assigned cores
-        else:
-            num_processes = 6
+        self.num_processes = None  # set by calibrate_num_processes() (only used for the train pipeline)
+        self.num_cached_per_queue = 1
+
+    def calibrate_num_processes(self, model, subjects, nr_batches=5):
+        """
+        Choose the number of augmentation processes and the queue size so that batch generation keeps up with
+        training: measures the time for generating and augmenting one batch in this process and the time for
+        training the model on one batch. Uses at most the CPUs available to this process (affinity and cgroup
+        quota). Weights and optimizer state of the model are restored afterwards.
+
+        Args:
+            model: model (BaseModel)
+            subjects: subjects to sample the batches from
+            nr_batches: nr of batches to measure
+
+        Returns:
+            Void
+        """
+        batch_generator = self._get_batch_generator_random(self.Config.BATCH_SIZE, subjects)
+        transforms = self._get_transforms(type="train")
+
+        start_time = time.time()
+        try:
+            batches = [transforms(**batch_generator.generate_train_batch()) for _ in range(nr_batches)]
+        finally:
+            # Do not keep the subject loading thread, pool and cache in the main process
+            if hasattr(batch_generator, "stop"):
+                batch_generator.stop()
+        time_produce = (time.time() - start_time) / nr_batches
+
+        net_state = copy.deepcopy(model.net.state_dict())
+        optimizer_state = copy.deepcopy(model.optimizer.state_dict())
+        model.train(batches[0]["data"], batches[0]["seg"], slice_dir=batches[0].get("slice_dir"))  # warm up
+        start_time = time.time()
+        for batch in batches:
+            model.train(batch["data"], batch["seg"], slice_dir=batch.get("slice_dir"))
+        time_consume = (time.time() - start_time) / nr_batches
+        model.net.load_state_dict(net_state)
+        model.optimizer.load_state_dict(optimizer_state)
+
+        # One process more than needed to compensate for slow batches (e.g. loading new subject); keep one CPU
+        # for the main process
+        nr_needed = int(np.ceil(time_produce / time_consume))
+        nr_cpus = exp_utils.get_nr_available_cpus()
+        self.num_processes = int(np.clip(nr_needed + 1, 1, max(nr_cpus - 1, 1)))
+        # Bigger queue only helps if the processes can produce faster than the model trains
+        self.num_cached_per_queue = 2 if self.num_processes > nr_needed else 1
+        exp_utils.print_and_save(self.Config.EXP_PATH,
+                                 "Augmentation: {}s per batch, training: {}s per batch, CPUs: {} -> "
+                                 "{} processes, {} cached per queue".format(round(time_produce, 3),
+                                                                            round(time_consume, 3), nr_cpus,
+                                                                            self.num_processes,
+                                                                            self.num_cached_per_queue))
+
+    def _get_transforms(self, type=None):
 
         tfs = []
 
@@ -353,7 +649,9 @@ class DataLoaderTraining:
                 # patch_center_dist_from_border:
                 #   if 144/2=72 -> always exactly centered; otherwise a bit off center
                 #   (brain can get off image and will be cut then)
-                if self.Config.DAUG_SCALE:
+                # With DAUG_TORCH the spatial transform, blur and noise are done by the model on the GPU (only 2D)
+                daug_torch = self.Config.DAUG_TORCH and self.Config.DIM == "2D"
+                if self.Config.DAUG_SCALE and not daug_torch:
 
                     if self.Config.INPUT_RESCALING:
                         source_mm = 2  # for bb
@@ -393,12 +691,12 @@ class DataLoaderTraining:
                 if self.Config.DAUG_RESAMPLE_LEGACY:
                     tfs.append(ResampleTransformLegacy(zoom_range=(0.5, 1)))
 
-                if self.Config.DAUG_GAUSSIAN_BLUR:
+                if self.Config.DAUG_GAUSSIAN_BLUR and not daug_torch:
                     tfs.append(GaussianBlurTransform(blur_sigma=self.Config.DAUG_BLUR_SIGMA,
                                                      different_sigma_per_channel=False,
                                                      p_per_sample=self.Config.P_SAMP))
 
-                if self.Config.DAUG_NOISE:
+                if self.Config.DAUG_NOISE and not daug_torch:
                     tfs.append(GaussianNoiseTransform(noise_variance=self.Config.DAUG_NOISE_VARIANCE,
                                                       p_per_sample=self.Config.P_SAMP))
 
@@ -409,25 +707,44 @@ class DataLoaderTraining:
                     tfs.append(FlipVectorAxisTransform())
 
         tfs.append(NumpyToTensor(keys=["data", "seg"], cast_to="float"))
+        return Compose(tfs)
+
+    def _augment_data(self, batch_generator, type=None):
+
+        if self.num_processes is not None:
+            # Calibrated for the train pipeline. Validation batches are not augmented; a few processes are enough
+            # (otherwise the validation workers would take as many CPUs again).
+            num_processes = self.num_processes if type == "train" else min(2, self.num_processes)
+        elif self.Config.DATA_AUGMENTATION:
+            num_processes = 15  # 15 is a bit faster than 8 on cluster
+            # num_processes = multiprocessing.cpu_count()  # on cluster: gives all cores, not only assigned cores
+        else:
+            num_processes = 6
+        num_cached_per_queue = self.num_cached_per_queue if type == "train" else 1
 
         #num_cached_per_queue 1 or 2 does not really make a difference
-        batch_gen = MultiThreadedAugmenter(batch_generator, Compose(tfs), num_processes=num_processes,
-                                           num_cached_per_queue=1, seeds=None, pin_memory=True)
+        batch_gen = MultiThreadedAugmenter(batch_generator, self._get_transforms(type=type),
+                                           num_processes=num_processes,
+                                           num_cached_per_queue=num_cached_per_queue, seeds=None,
+                                           pin_memory=True)
         return batch_gen  # data: (batch_size, channels, x, y), seg: (batch_size, channels, x, y)
 
-
-    def get_batch_generator(self, batch_size=128, type=None, subjects=None):
+    def _get_batch_generator_random(self, batch_size, subjects):
         data = subjects
         seg = []
 
         if self.Config.TYPE == "combined":
             batch_gen = BatchGenerator2D_Npy_random((data, seg), batch_size=batch_size)
+        elif self.Config.TRAINING_DATA_FORMAT == "npy_slices":
+            batch_gen = BatchGenerator2D_Npy_slices_random((data, seg), batch_size=batch_size)
         else:
             batch_gen = BatchGenerator2D_Nifti_random((data, seg), batch_size=batch_size)
             # batch_gen = SlicesBatchGeneratorRandomNiftiImg_5slices((data, seg), batch_size=batch_size)
 
         batch_gen.Config = self.Config
+        return batch_gen
 
+    def get_batch_generator(self, batch_size=128, type=None, subjects=None):
+        batch_gen = self._get_batch_generator_random(batch_size, subjects)
         batch_gen = self._augment_data(batch_gen, type=type)
-
         return batch_gen
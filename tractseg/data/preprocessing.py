@@ -1,6 +1,10 @@
 """
 Run this script to crop images + segmentations to brain area. Then save as nifti.
 Reduces datasize and therefore IO by at least factor of 2.
+
+Afterwards the cropped images can additionally be converted to uncompressed, memory mapped npy files with one
+file per slice direction (set CREATE_SLICE_FILES = True). Training with Config.TRAINING_DATA_FORMAT = "npy_slices"
+then only reads the sampled slices from disk instead of decompressing the entire nifti images for each batch.
 """
 
 from __future__ import absolute_import
@@ -25,6 +29,8 @@ dataset = "HCP_final"
 DATASET_FOLDER = "HCP_for_training_COPY"  # source folder
 DATASET_FOLDER_PREPROC = "HCP_preproc"  # target folder
 
+CREATE_SLICE_FILES = False  # convert preprocessed nifti images to npy slice files instead of cropping
+
 # dataset = "HCP_all"
 # DATASET_FOLDER = "data/HCP_all_training"
 # DATASET_FOLDER_PREPROC = "HCP_preproc_all"
@@ -114,9 +120,33 @@ def create_preprocessed_files(subject):
             raise IOError("File missing")
 
 
+def create_slice_files(subject):
+    """
+    Convert the preprocessed nifti images of one subject to npy files with one file per slice direction.
+    Features are saved as float32, binary labels are bit-packed (see data_utils.save_as_slices).
+    """
+    # todo: adapt
+    filenames_data = ["12g_125mm_peaks", "90g_125mm_peaks", "270g_125mm_peaks"]
+    filenames_seg = ["bundle_masks_72"]
+
+    print("idx: {}".format(subjects.index(subject)))
+    for filename in filenames_data + filenames_seg:
+        path = join(C.DATA_PATH, DATASET_FOLDER_PREPROC, subject, filename)
+        if not os.path.exists(path + ".nii.gz"):
+            print("Missing file: {}-{}".format(subject, filename))
+            raise IOError("File missing")
+        data = np.nan_to_num(nib.load(path + ".nii.gz").get_data())
+        if filename in filenames_data:
+            data = data.astype(np.float32)
+        data_utils.save_as_slices(data, path, pack_binary=filename in filenames_seg)
+
+
 if __name__ == "__main__":
     print("Output folder: {}".format(DATASET_FOLDER_PREPROC))
     subjects = get_all_subjects(dataset=dataset)
-    Parallel(n_jobs=12)(delayed(create_preprocessed_files)(subject) for subject in subjects)
+    if CREATE_SLICE_FILES:
+        Parallel(n_jobs=12)(delayed(create_slice_files)(subject) for subject in subjects)
+    else:
+        Parallel(n_jobs=12)(delayed(create_preprocessed_files)(subject) for subject in subjects)
     # for subject in subjects:
     #     create_preprocessed_files(subject)
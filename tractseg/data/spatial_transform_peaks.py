@@ -8,71 +8,100 @@ import numpy as np
 from batchgenerators.transforms.abstract_transforms import AbstractTransform
 from batchgenerators.augmentations.utils import create_zero_centered_coordinate_mesh
 from batchgenerators.augmentations.utils import elastic_deform_coordinates
-from batchgenerators.augmentations.utils import rotate_coords_3d
 from batchgenerators.augmentations.utils import rotate_coords_2d
 from batchgenerators.augmentations.utils import scale_coords
-from batchgenerators.augmentations.utils import create_matrix_rotation_x_3d
-from batchgenerators.augmentations.utils import create_matrix_rotation_y_3d
-from batchgenerators.augmentations.utils import create_matrix_rotation_z_3d
 from batchgenerators.augmentations.utils import interpolate_img
 from batchgenerators.augmentations.crop_and_pad_augmentations import random_crop as random_crop_aug
 from batchgenerators.augmentations.crop_and_pad_augmentations import center_crop as center_crop_aug
 
-from tractseg.libs import peak_utils
 
-
-def rotate_multiple_peaks(data, angle_x, angle_y, angle_z):
+def get_rotation_matrices(angles_x, angles_y, angles_z):
     """
-    Rotates the peaks by the given angles.
+    Create one rotation matrix per sample. Same as applying create_matrix_rotation_x_3d,
+    create_matrix_rotation_y_3d and create_matrix_rotation_z_3d one after the other.
 
-    data: 2D or 3D 3-peak image (9, x, y, [z])
-    """
-    def rotate_peaks(peaks, angle_x, angle_y, angle_z):
-        rot_matrix = np.identity(3)
-        rot_matrix = create_matrix_rotation_x_3d(angle_x, rot_matrix)
-        rot_matrix = create_matrix_rotation_y_3d(angle_y, rot_matrix)
-        rot_matrix = create_matrix_rotation_z_3d(angle_z, rot_matrix)
-        # rotate clockwise -> wrong
-        # peaks_rot = np.dot(peaks.reshape(3, -1).transpose(), rot_matrix).transpose().reshape(peaks.shape)
-        # rotate counterclockwise -> this is correct
-        peaks_rot = np.dot(rot_matrix, peaks.reshape(3, -1)).reshape(peaks.shape)
-        return peaks_rot
+    Args:
+        angles_x: angles around x axis [bs]
+        angles_y: angles around y axis [bs]
+        angles_z: angles around z axis [bs]
 
-    peaks_rot = np.zeros(data.shape)
-    for i in range(3):
-        peaks_rot[i*3:(i+1)*3, ...] = rotate_peaks(data[i*3:(i+1)*3, ...], angle_x, angle_y, angle_z)
+    Returns:
+        rotation matrices [bs, 3, 3]
+    """
+    def rotation_matrices(angles, axis):
+        # Rows/columns of the two axes spanning the rotation plane
+        a, b = [(1, 2), (2, 0), (0, 1)][axis]
+        rot = np.zeros((len(angles), 3, 3))
+        rot[:, axis, axis] = 1
+        rot[:, a, a] = np.cos(angles)
+        rot[:, a, b] = -np.sin(angles)
+        rot[:, b, a] = np.sin(angles)
+        rot[:, b, b] = np.cos(angles)
+        return rot
+
+    return rotation_matrices(np.asarray(angles_x, dtype=np.float64), 0) @ \
+           rotation_matrices(np.asarray(angles_y, dtype=np.float64), 1) @ \
+           rotation_matrices(np.asarray(angles_z, dtype=np.float64), 2)
+
+
+def rotate_multiple_peaks(data, rot_matrices):
+    """
+    Rotates the peaks of each sample by the rotation matrix of the sample.
 
-    return peaks_rot
+    data: batch of 2D or 3D 3-peak images (bs, 9, x, y, [z])
+    rot_matrices: rotation matrix for each sample (bs, 3, 3)
+    """
+    peaks = data.reshape((data.shape[0], -1, 3) + data.shape[2:])  # (bs, nr_peaks, 3, x, y, [z])
+    # rotate clockwise -> wrong
+    # peaks_rot = np.einsum("bji,bpj...->bpi...", rot_matrices, peaks)
+    # rotate counterclockwise -> this is correct
+    peaks_rot = np.einsum("bij,bpj...->bpi...", rot_matrices, peaks)
+    return peaks_rot.reshape(data.shape)
 
 
-def rotate_multiple_tensors(data, angle_x, angle_y, angle_z):
+def rotate_multiple_tensors(data, rot_matrices):
     """
-    Rotates the tensors by the given angles.
+    Rotates the tensors of each sample by the rotation matrix of the sample.
 
-    data: 2D or 3D 3-tensor image (18, x, y, [z])
+    data: batch of 2D or 3D 3-tensor images (bs, 18, x, y, [z])
+    rot_matrices: rotation matrix for each sample (bs, 3, 3)
+    """
+    tensors = data.reshape((data.shape[0], -1, 6) + data.shape[2:])  # (bs, nr_tensors, 6, x, y, [z])
+    # flat tensor (xx, xy, xz, yy, yz, zz) to matrix -> (bs, nr_tensors, 3, 3, x, y, [z])
+    tensors = tensors[:, :, [[0, 1, 2], [1, 3, 4], [2, 4, 5]]]
+    # rotate clockwise -> wrong
+    # tensors_rot = rot_matrix.T @ tensors @ rot_matrix
+    # rotate counterclockwise -> this is correct
+    tensors_rot = np.einsum("bij,bpjk...,blk->bpil...", rot_matrices, tensors, rot_matrices)  # R @ T @ R.T
+    tensors_rot = tensors_rot[:, :, [0, 0, 0, 1, 1, 2], [0, 1, 2, 1, 2, 2]]  # back to flat tensor
+    return tensors_rot.reshape(data.shape)
+
+
+def interpolate_img_nearest(img, coords, mode="constant", cval=0):
     """
-    data = np.moveaxis(data, 0, -1)  # move channels to back
+    Same as map_coordinates with order=0 for each channel of img (only mode 'constant' and 'nearest'), but
+    computes the nearest voxel only once and then takes all channels with one indexing operation.
 
-    def rotate_tensors(peaks, angle_x, angle_y, angle_z):
-        rot_matrix = np.identity(3)
-        rot_matrix = create_matrix_rotation_x_3d(angle_x, rot_matrix)
-        rot_matrix = create_matrix_rotation_y_3d(angle_y, rot_matrix)
-        rot_matrix = create_matrix_rotation_z_3d(angle_z, rot_matrix)
+    img: (channels, x, y, [z])
+    coords: (dim, x', y', [z'])
 
-        peaks = peak_utils.flat_tensor_to_matrix_tensor(peaks)  # (x, y, 3, 3)
-        # rotate clockwise -> wrong
-        # peaks_rot = rot_matrix.T @ peaks @ rot_matrix  # (x, y, 3, 3)
-        # rotate counterclockwise -> this is correct
-        peaks_rot = rot_matrix @ peaks @ rot_matrix.T  # (x, y, 3, 3)
-        peaks_rot = peak_utils.matrix_tensor_to_flat_tensor(peaks_rot)
-        return peaks_rot
+    Returns:
+        (channels, x', y', [z'])
+    """
+    shape = np.array(img.shape[1:]).reshape((-1,) + (1,) * (coords.ndim - 1))
+    idxs = np.clip(np.floor(coords + 0.5).astype(np.int64), 0, shape - 1)
+    result = img[(slice(None),) + tuple(idxs)]
+    if mode == "constant":
+        # map_coordinates does not extrapolate beyond the edges of the image
+        result[:, np.any((coords < 0) | (coords > shape - 1), axis=0)] = cval
+    return result
 
-    peaks_rot = np.zeros(data.shape)
-    for i in range(3):
-        peaks_rot[..., i*6:(i+1)*6] = rotate_tensors(data[..., i*6:(i+1)*6], angle_x, angle_y, angle_z)
 
-    peaks_rot = np.moveaxis(peaks_rot, -1, 0)  # move channels to front
-    return peaks_rot
+def _interpolate_channels(img, coords, order, mode, cval, is_seg=False):
+    if order == 0 and mode in ["constant", "nearest"]:
+        return interpolate_img_nearest(img, coords, mode, cval=cval)
+    return np.array([interpolate_img(img[channel_id], coords, order, mode, cval=cval, is_seg=is_seg)
+                     for channel_id in range(img.shape[0])])
 
 
 def augment_spatial_peaks(data, seg, patch_size, patch_center_dist_from_border=30,
@@ -82,6 +111,13 @@ def augment_spatial_peaks(data, seg, patch_size, patch_center_dist_from_border=3
                     border_mode_seg='constant', border_cval_seg=0, order_seg=0, random_crop=True, p_el_per_sample=1,
                     p_scale_per_sample=1, p_rot_per_sample=1, slice_dir=None):
     dim = len(patch_size)
+    if dim > 2:
+        raise ValueError("augment_spatial_peaks only supports 2D at the moment")
+    if data.shape[1] not in [9, 18]:
+        raise ValueError("Incorrect number of channels (expected 9 or 18)")
+    if slice_dir not in [0, 1, 2]:
+        raise ValueError("invalid slice_dir passed as argument")
+
     seg_result = None
     if seg is not None:
         if dim == 2:
@@ -99,6 +135,8 @@ def augment_spatial_peaks(data, seg, patch_size, patch_center_dist_from_border=3
     if not isinstance(patch_center_dist_from_border, (list, tuple, np.ndarray)):
         patch_center_dist_from_border = dim * [patch_center_dist_from_border]
 
+    sampled_2D_angles = np.zeros(data.shape[0])
+
     for sample_id in range(data.shape[0]):
         coords = create_zero_centered_coordinate_mesh(patch_size)
         modified_coords = False
@@ -109,28 +147,14 @@ def augment_spatial_peaks(data, seg, patch_size, patch_center_dist_from_border=3
             coords = elastic_deform_coordinates(coords, a, s)
             modified_coords = True
 
-        # NEW: initialize all because all needed for rotate_multiple_peaks (even if only rotating along one axis)
-        a_x = 0
-        a_y = 0
-        a_z = 0
-
         if np.random.uniform() < p_rot_per_sample and do_rotation:
             if angle_x[0] == angle_x[1]:
                 a_x = angle_x[0]
             else:
                 a_x = np.random.uniform(angle_x[0], angle_x[1])
-            if dim == 3:
-                if angle_y[0] == angle_y[1]:
-                    a_y = angle_y[0]
-                else:
-                    a_y = np.random.uniform(angle_y[0], angle_y[1])
-                if angle_z[0] == angle_z[1]:
-                    a_z = angle_z[0]
-                else:
-                    a_z = np.random.uniform(angle_z[0], angle_z[1])
-                coords = rotate_coords_3d(coords, a_x, a_y, a_z)
-            else:
-                coords = rotate_coords_2d(coords, a_x)
+            # if 2D angle will always be a_x even if rotating other axis
+            sampled_2D_angles[sample_id] = a_x
+            coords = rotate_coords_2d(coords, a_x)
             modified_coords = True
 
         if np.random.uniform() < p_scale_per_sample and do_scale:
@@ -150,14 +174,11 @@ def augment_spatial_peaks(data, seg, patch_size, patch_center_dist_from_border=3
                 else:
                     ctr = int(np.round(data.shape[d + 2] / 2.))
                 coords[d] += ctr
-            for channel_id in range(data.shape[1]):
-                data_result[sample_id, channel_id] = interpolate_img(data[sample_id, channel_id], coords, order_data,
-                                                                     border_mode_data, cval=border_cval_data)
+            data_result[sample_id] = _interpolate_channels(data[sample_id], coords, order_data, border_mode_data,
+                                                           cval=border_cval_data)
             if seg is not None:
-                for channel_id in range(seg.shape[1]):
-                    seg_result[sample_id, channel_id] = interpolate_img(seg[sample_id, channel_id], coords, order_seg,
-                                                                        border_mode_seg, cval=border_cval_seg,
-                                                                        is_seg=True)
+                seg_result[sample_id] = _interpolate_channels(seg[sample_id], coords, order_seg, border_mode_seg,
+                                                              cval=border_cval_seg, is_seg=True)
         else:
             if seg is None:
                 s = None
@@ -172,33 +193,20 @@ def augment_spatial_peaks(data, seg, patch_size, patch_center_dist_from_border=3
             if seg is not None:
                 seg_result[sample_id] = s[0]
 
-        # NEW: Rotate Peaks / Tensors
-        if dim > 2:
-            raise ValueError("augment_spatial_peaks only supports 2D at the moment")
-
-        sampled_2D_angle = a_x  # if 2D angle will always be a_x even if rotating other axis
-        a_x = 0
-        a_y = 0
-        a_z = 0
-
-        if slice_dir == 0:
-            a_x = sampled_2D_angle
-        elif slice_dir == 1:
-            a_y = sampled_2D_angle
-        elif slice_dir == 2:
-            # Somehow we have to invert rotation direction for z to make align properly with rotated voxels.
-            #  Unclear why this is the case. Maybe some different conventions for peaks and voxels??
-            a_z = sampled_2D_angle * -1
-        else:
-            raise ValueError("invalid slice_dir passed as argument")
+    # NEW: Rotate Peaks / Tensors of all samples at once
+    angles = [np.zeros(data.shape[0]) for _ in range(3)]
+    if slice_dir == 2:
+        # Somehow we have to invert rotation direction for z to make align properly with rotated voxels.
+        #  Unclear why this is the case. Maybe some different conventions for peaks and voxels??
+        angles[slice_dir] = sampled_2D_angles * -1
+    else:
+        angles[slice_dir] = sampled_2D_angles
+    rot_matrices = get_rotation_matrices(*angles)
 
-        data_aug = data_result[sample_id]
-        if data_aug.shape[0] == 9:
-            data_result[sample_id] = rotate_multiple_peaks(data_aug, a_x, a_y, a_z)
-        elif data_aug.shape[0] == 18:
-            data_result[sample_id] = rotate_multiple_tensors(data_aug, a_x, a_y, a_z)
-        else:
-            raise ValueError("Incorrect number of channels (expected 9 or 18)")
+    if data_result.shape[1] == 9:
+        data_result[:] = rotate_multiple_peaks(data_result, rot_matrices)
+    else:
+        data_result[:] = rotate_multiple_tensors(data_result, rot_matrices)
 
     return data_result, seg_result
 
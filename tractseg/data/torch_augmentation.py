@@ -0,0 +1,197 @@
+"""
+Data augmentation with torch. Is applied to a batch after it was transferred to the GPU (in BaseModel.train), so
+the most expensive augmentations do not have to be done in the augmentation processes on the CPU. Also works
+on the CPU if no GPU is available.
+
+Info:
+Dimensions order: (batch_size, channels, x, y)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def _uniform(value_range, size, device):
+    return torch.rand(size, device=device) * (value_range[1] - value_range[0]) + value_range[0]
+
+
+def _bernoulli(p, size, device):
+    return torch.rand(size, device=device) < p
+
+
+def gaussian_blur(x, sigmas, padding_mode="reflect"):
+    """
+    Gaussian blur with a different sigma for each sample (separable convolution).
+
+    Args:
+        x: 2D batch (bs, channels, x, y)
+        sigmas: sigma for each sample (bs); 0 means no blurring
+        padding_mode: reflect | constant (pad with 0)
+
+    Returns:
+        blurred batch (bs, channels, x, y)
+    """
+    bs, nr_channels = x.shape[:2]
+    radius = max(int(math.ceil(4 * float(sigmas.max()))), 1)  # same truncation as scipy gaussian_filter
+    offsets = torch.arange(-radius, radius + 1, device=x.device, dtype=x.dtype)
+    kernels = torch.exp(-0.5 * (offsets[None, :] / sigmas.to(x.dtype).clamp(min=1e-6)[:, None]) ** 2)
+    kernels = kernels / kernels.sum(dim=1, keepdim=True)
+    kernels = kernels.repeat_interleave(nr_channels, dim=0)  # (bs*channels, kernel_size)
+
+    # Treat each channel of each sample as one group of a depthwise convolution
+    x = F.pad(x.reshape((1, bs * nr_channels) + x.shape[2:]), [radius] * 4, mode=padding_mode)
+    x = F.conv2d(x, kernels[:, None, :, None], groups=bs * nr_channels)
+    x = F.conv2d(x, kernels[:, None, None, :], groups=bs * nr_channels)
+    return x.reshape((bs, nr_channels) + x.shape[2:])
+
+
+def get_rotation_matrices(angles, axis):
+    """
+    Rotation matrices for rotating around one axis (same convention as
+    batchgenerators.augmentations.utils.create_matrix_rotation_[x|y|z]_3d).
+
+    Args:
+        angles: angle for each sample (bs)
+        axis: 0|1|2
+
+    Returns:
+        rotation matrices (bs, 3, 3)
+    """
+    a, b = [(1, 2), (2, 0), (0, 1)][axis]
+    rot = torch.zeros((len(angles), 3, 3), device=angles.device, dtype=angles.dtype)
+    rot[:, axis, axis] = 1
+    rot[:, a, a] = torch.cos(angles)
+    rot[:, a, b] = -torch.sin(angles)
+    rot[:, b, a] = torch.sin(angles)
+    rot[:, b, b] = torch.cos(angles)
+    return rot
+
+
+def rotate_peaks(x, rot_matrices):
+    """
+    Rotate peaks (9 channels) or tensors (18 channels) of each sample.
+
+    Args:
+        x: 2D batch (bs, 9|18, x, y)
+        rot_matrices: rotation matrix for each sample (bs, 3, 3)
+
+    Returns:
+        rotated batch
+    """
+    if x.shape[1] == 9:
+        peaks = x.reshape((x.shape[0], 3, 3) + x.shape[2:])
+        return torch.einsum("bij,bpjxy->bpixy", rot_matrices, peaks).reshape(x.shape)
+    elif x.shape[1] == 18:
+        tensors = x.reshape((x.shape[0], 3, 6) + x.shape[2:])
+        # flat tensor (xx, xy, xz, yy, yz, zz) to matrix
+        tensors = tensors[:, :, [0, 1, 2, 1, 3, 4, 2, 4, 5]].reshape((x.shape[0], 3, 3, 3) + x.shape[2:])
+        tensors = torch.einsum("bij,bpjkxy,blk->bpilxy", rot_matrices, tensors, rot_matrices)  # R @ T @ R.T
+        tensors = tensors.reshape((x.shape[0], 3, 9) + x.shape[2:])[:, :, [0, 1, 2, 4, 5, 8]]
+        return tensors.reshape(x.shape)
+    else:
+        raise ValueError("Incorrect number of channels (expected 9 or 18)")
+
+
+class TorchAugmentation(object):
+    """
+    Does the spatial transform (elastic deformation, rotation, scaling, random crop), gaussian blur and gaussian
+    noise of DataLoaderTraining with torch. Uses the same Config options and sampling of parameters.
+
+    Differences to the augmentation with batchgenerators: data is interpolated linearly (instead of 3rd order
+    spline) and the elastic deformation field is generated with torch random numbers.
+    """
+    def __init__(self, Config):
+        self.Config = Config
+
+        if Config.INPUT_RESCALING:
+            source_mm = 2  # for bb
+            target_mm = float(Config.RESOLUTION[:-2])
+            scale_factor = target_mm / source_mm
+            self.scale = (scale_factor, scale_factor)
+        else:
+            self.scale = (0.9, 1.5)
+        self.center_dist_from_border = int(Config.INPUT_DIM[0] / 2.) - 10  # (144,144) -> 62
+
+    def _spatial_transform(self, x, y, slice_dir):
+        bs = x.shape[0]
+        shape = x.shape[2:]
+        device = x.device
+        p_samp = self.Config.P_SAMP
+
+        # Coordinates centered at 0 (like create_zero_centered_coordinate_mesh)
+        ranges = [torch.arange(n, device=device, dtype=torch.float32) - (n - 1) / 2. for n in shape]
+        mesh = [ranges[0][:, None].expand(shape), ranges[1][None, :].expand(shape)]  # same as meshgrid with "ij"
+        coords = torch.stack(mesh)[None].repeat(bs, 1, 1, 1)  # (bs, 2, x, y)
+
+        if self.Config.DAUG_ELASTIC_DEFORM:
+            alphas = _uniform(self.Config.DAUG_ALPHA, bs, device) * _bernoulli(p_samp, bs, device)
+            sigmas = _uniform(self.Config.DAUG_SIGMA, bs, device)
+            noise = torch.rand(coords.shape, device=device) * 2 - 1
+            coords = coords + gaussian_blur(noise, sigmas, padding_mode="constant") * alphas[:, None, None, None]
+
+        angles = torch.zeros(bs, device=device)
+        if self.Config.DAUG_ROTATE:
+            angles = _uniform(self.Config.DAUG_ROTATE_ANGLE, bs, device) * _bernoulli(p_samp, bs, device)
+            # Same as rotate_coords_2d
+            cos = torch.cos(angles)[:, None, None]
+            sin = torch.sin(angles)[:, None, None]
+            coords = torch.stack([cos * coords[:, 0] + sin * coords[:, 1],
+                                  -sin * coords[:, 0] + cos * coords[:, 1]], dim=1)
+
+        downscale = _bernoulli(0.5, bs, device) & (self.scale[0] < 1)
+        scales = torch.where(downscale, _uniform((self.scale[0], 1), bs, device),
+                             _uniform((max(self.scale[0], 1), self.scale[1]), bs, device))
+        scales = torch.where(_bernoulli(p_samp, bs, device), scales, torch.ones_like(scales))
+        coords = coords * scales[:, None, None, None]
+
+        # Random center location
+        for d in range(2):
+            border = min(self.center_dist_from_border, shape[d] / 2.)
+            coords[:, d] += _uniform((border, shape[d] - border), bs, device)[:, None, None]
+
+        # grid_sample expects coordinates normalized to [-1, 1] in order (y, x)
+        grid = torch.stack([coords[:, 1] / (shape[1] - 1) * 2 - 1, coords[:, 0] / (shape[0] - 1) * 2 - 1], dim=-1)
+        x = F.grid_sample(x, grid, mode="bilinear", padding_mode="zeros", align_corners=True)
+        y = F.grid_sample(y, grid, mode="nearest", padding_mode="zeros", align_corners=True)
+
+        if self.Config.SPATIAL_TRANSFORM == "SpatialTransformPeaks":
+            if slice_dir not in [0, 1, 2]:
+                raise ValueError("invalid slice_dir passed as argument")
+            if slice_dir == 2:
+                # Same as SpatialTransformPeaks: rotation direction has to be inverted for z
+                angles = angles * -1
+            x = rotate_peaks(x, get_rotation_matrices(angles, slice_dir))
+        return x, y
+
+    def __call__(self, x, y, slice_dir=None):
+        """
+        Args:
+            x: 2D batch (bs, channels, x, y)
+            y: labels (bs, classes, x, y)
+            slice_dir: slice direction of the batch (needed for rotating peaks)
+
+        Returns:
+            augmented x and y
+        """
+        bs = x.shape[0]
+        p_samp = self.Config.P_SAMP
+
+        if self.Config.DAUG_SCALE:
+            x, y = self._spatial_transform(x, y, slice_dir)
+
+        if self.Config.DAUG_GAUSSIAN_BLUR:
+            sigmas = _uniform(self.Config.DAUG_BLUR_SIGMA, bs, x.device) * _bernoulli(p_samp, bs, x.device)
+            x = gaussian_blur(x, sigmas)
+
+        if self.Config.DAUG_NOISE:
+            # Like GaussianNoiseTransform the sampled "variance" is used as standard deviation
+            stds = _uniform(self.Config.DAUG_NOISE_VARIANCE, bs, x.device) * _bernoulli(p_samp, bs, x.device)
+            x = x + torch.randn_like(x) * stds[:, None, None, None]
+
+        return x, y
@@ -30,6 +30,7 @@ class Config:
     RESOLUTION = "1.25mm"  # 1.25mm|2.5mm
     # 12g90g270g | 270g_125mm_xyz | 270g_125mm_peaks | 90g_125mm_peaks | 32g_25mm_peaks | 32g_25mm_xyz
     FEATURES_FILENAME = "12g90g270g"
+    TRAINING_DATA_FORMAT = "nifti"  # nifti | npy_slices (see tractseg/data/preprocessing.py)
     LABELS_FILENAME = ""  # autofilled
     LABELS_TYPE = "int"
     THRESHOLD = 0.5  # Binary: 0.5, Regression: 0.01
@@ -86,10 +87,16 @@ class Config:
     BEST_EPOCH = 0
     VERBOSE = True
     CALC_F1 = True
+    TRAIN_METRICS_FREQ = 1  # calculate f1 of training batches only every n batches (saves time)
     ONLY_VAL = False
     TEST_TIME_DAUG = False
     PAD_TO_SQUARE = True
     INPUT_RESCALING = False  # Resample data to different resolution (instead of doing in preprocessing))
+    NR_BATCHES_PER_SUBJECT = 1  # nr of batches sampled from a subject before selecting the next one
+    SUBJECT_POOL_SIZE = 0  # sample each batch from a pool of this many subjects (0: one subject per batch)
+    SLICE_LAYOUT = False  # keep subjects as contiguous slices per training slice direction (up to 3x memory)
+    SUBJECT_CACHE_SIZE = 0  # MB of loaded subjects kept in memory per augmentation worker (0: only current one)
+    AUTO_AUGMENTATION_PROCESSES = False  # choose nr of augmentation processes by available CPUs and speed (2D)
 
     # data augmentation
     DATA_AUGMENTATION = True
@@ -108,6 +115,7 @@ class Config:
     DAUG_MIRROR = False
     DAUG_FLIP_PEAKS = False
     SPATIAL_TRANSFORM = "SpatialTransform"  # SpatialTransform|SpatialTransformPeaks
+    DAUG_TORCH = False  # spatial transform, blur and noise with torch on the GPU (only 2D; CPU if no GPU available)
     P_SAMP = 1.0
     DAUG_INFO = "-"
     INFO = "-"
@@ -3,7 +3,6 @@ This is a python version of this function:
 https://github.com/yeatmanlab/AFQ/blob/master/functions/AFQ_MultiCompCorrection.m
 """
 
-import random
 import numpy as np
 import scipy.stats
 
@@ -39,29 +38,104 @@ def get_significant_areas(pvals, clusterFWE, alpha=0.05):
     return np.array(result)
 
 
-def _corr(a, b):
+def _corr(y_perm, data):
     """
-    Correlate a with each row of b
+    Pearson correlation of each row of y_perm with each column of data (closed form for all rows at once).
 
     Args:
-        a: 1d array
-        b: 2d array
+        y_perm: 2d array [nr_permutations, nr_samples]
+        data: 2d array [nr_samples, nr_positions]
 
     Returns:
-        c: 1d array with correlations
-        p: 1d array with p-values
+        c: 2d array with correlations [nr_permutations, nr_positions]
+        p: 2d array with p-values [nr_permutations, nr_positions]
     """
-    b = b.T
-    c = []
-    p = []
-    for i in range(len(b)):
-        c_i, p_i = scipy.stats.pearsonr(a, b[i])
-        c.append(c_i)
-        p.append(p_i)
+    n = data.shape[0]
+    y_perm = y_perm - y_perm.mean(axis=1, keepdims=True)
+    y_perm = y_perm / np.linalg.norm(y_perm, axis=1, keepdims=True)
+    data = data - data.mean(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        data = data / np.linalg.norm(data, axis=0)
+        c = np.clip(np.dot(y_perm, data), -1, 1)
+        # same as scipy.stats.pearsonr: two-sided p-value of t-statistic with n-2 degrees of freedom
+        t = c * np.sqrt((n - 2) / (1 - c ** 2))
+    p = 2 * scipy.stats.t.sf(np.abs(t), n - 2)
     return c, p
 
 
-def AFQ_MultiCompCorrection(data=None, y=None, alpha=0.05, cThresh=None, nperm=1000):
+def _ttest(groups, data):
+    """
+    Independent t-test (equal variances, like scipy.stats.ttest_ind) between samples with group 1 and group 0 for
+    each row of groups and each column of data (closed form for all rows at once).
+
+    Args:
+        groups: 2d bool array [nr_permutations, nr_samples]
+        data: 2d array [nr_samples, nr_positions]
+
+    Returns:
+        t: 2d array with t-values [nr_permutations, nr_positions]
+        p: 2d array with p-values [nr_permutations, nr_positions]
+    """
+    # Center data to reduce cancellation when computing variances from sums of squares
+    data = data - data.mean(axis=0)
+    groups = groups.astype(np.float64)
+    n1 = groups.sum(axis=1, keepdims=True)
+    n0 = data.shape[0] - n1
+    sum1 = np.dot(groups, data)
+    sum0 = data.sum(axis=0) - sum1
+    sum_sq1 = np.dot(groups, data ** 2)
+    sum_sq0 = (data ** 2).sum(axis=0) - sum_sq1
+    mean1 = sum1 / n1
+    mean0 = sum0 / n0
+    dof = n1 + n0 - 2
+    pooled_var = (sum_sq1 - n1 * mean1 ** 2 + sum_sq0 - n0 * mean0 ** 2) / dof
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = (mean1 - mean0) / np.sqrt(pooled_var * (1 / n1 + 1 / n0))
+    p = 2 * scipy.stats.t.sf(np.abs(t), dof)
+    return t, p
+
+
+def _get_max_cluster_size(p_thresh):
+    """
+    Size of the biggest cluster of consecutive True values + 1 in each row (same as the length of the longest
+    difference between two False entries after padding each row with False at both ends).
+
+    Args:
+        p_thresh: 2d bool array [nr_permutations, nr_positions]
+
+    Returns:
+        1d array [nr_permutations]
+    """
+    idxs = np.arange(p_thresh.shape[1])
+    last_false = np.maximum.accumulate(np.where(p_thresh, -1, idxs), axis=1)
+    run_lengths = idxs - last_false  # length of the cluster ending at each position (0 if not significant)
+    return run_lengths.max(axis=1) + 1
+
+
+def get_pointwise_statistics(data, y, stattest):
+    """
+    Statistic and p-value at each position (without permutations).
+
+    Args:
+        data: 2d array [nr_samples, nr_positions]
+        y: grouping variable (0 or 1) for ttest or values to correlate with for corr [nr_samples]
+        stattest: 'ttest' (t-value of group 0 vs group 1, like scipy.stats.ttest_ind) or 'corr' (correlation
+                  coefficient, like scipy.stats.pearsonr)
+
+    Returns:
+        stat: 1d array [nr_positions]
+        p: 1d array [nr_positions]
+    """
+    data = np.asarray(data, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64).ravel()
+    if stattest == 'ttest':
+        stat, p = _ttest((y == 0)[None], data)
+    else:
+        stat, p = _corr(y[None], data)
+    return stat[0], p[0]
+
+
+def AFQ_MultiCompCorrection(data=None, y=None, alpha=0.05, cThresh=None, nperm=1000, seed=None):
     """
     Compute a multiple comparison correction for Tract Profile data
 
@@ -92,6 +166,7 @@ def AFQ_MultiCompCorrection(data=None, y=None, alpha=0.05, cThresh=None, nperm=1
                  you can set a cluster threshold of 0.01 and then find clusters
                  that a large enough to pass FWE at a threshold of 0.05.
         nperm: number of permutations
+        seed:  seed for the random permutations (None: different permutations for each call)
 
     Returns:
         alphaFWE: This is the alpha (p value) that corresponds after adjustment
@@ -111,9 +186,11 @@ def AFQ_MultiCompCorrection(data=None, y=None, alpha=0.05, cThresh=None, nperm=1
     if cThresh is None:
         cThresh = alpha
 
+    data = np.asarray(data, dtype=np.float64)
+
     # If y is continues perform a correlation if binary perform a ttest
     if y is None or len(y) == 0:
-        y = np.random.randn(data.shape[0], 1)
+        y = np.random.randn(data.shape[0])
         print('No behavioral data provided so randn will be used')
         stattest = 'corr'
     else:
@@ -121,52 +198,41 @@ def AFQ_MultiCompCorrection(data=None, y=None, alpha=0.05, cThresh=None, nperm=1
             stattest = 'ttest'
         else:
             stattest = 'corr'
+    y = np.asarray(y, dtype=np.float64).ravel()
 
     # print("using stattest: {}".format(stattest))
 
-    p = np.zeros([nperm, data.shape[1]])
-    stat = np.zeros([nperm, data.shape[1]])
+    # All permutations are computed as matrix operations (in chunks to limit memory usage). Only the minimum p-value,
+    # maximum statistic and maximum cluster size of each permutation are kept.
+    rng = np.random.default_rng(seed)
+    pMin = np.zeros([nperm])
+    statMax = np.zeros([nperm])
     clusMax = np.zeros([nperm])
     stats = {}
 
-    if ('corr') == (stattest):
-        for ii in range(nperm):
-            # Shuffle the rows of the data
-            rows = np.array(random.sample(range(len(y)), len(y)))  # random shuffling of row indices
-            stat[ii, :], p[ii, :] = _corr(y, data[rows, :])
-    else:
-        if ('ttest') == (stattest):
-            for ii in range(nperm):
-                rows = np.array(random.sample(list(y), len(y)))
-                rows = rows > 0  # to bool
-                ttest_res = scipy.stats.ttest_ind(data[rows, :], data[~rows, :])   #independent t-test
-                p[ii, :] = ttest_res.pvalue
-                stat[ii, :] = ttest_res.statistic
+    chunk_size = max(1, int(5e6 / max(1, data.shape[1])))
+    for start in range(0, nperm, chunk_size):
+        nr = min(chunk_size, nperm - start)
+        # Shuffle y instead of the rows of the data (same result, but data does not have to be copied)
+        perms = np.argsort(rng.random((nr, len(y))), axis=1)  # random shuffling of row indices
+        if ('corr') == (stattest):
+            stat, p = _corr(y[perms], data)
+        else:
+            stat, p = _ttest(y[perms] > 0, data)  # independent t-test
+
+        pMin[start:start + nr] = p.min(axis=1)
+        statMax[start:start + nr] = stat.max(axis=1)
+
+        # Find the biggest cluster of p-values below threshold
+        clusMax[start:start + nr] = _get_max_cluster_size(p < cThresh)
 
     # Sort the pvals and associated statistics such that the first
     # entry is the most significant
-    stats["pMin"] = np.sort(p.min(axis=1))
-    stats["statMax"] = np.sort(stat.max(axis=1))[::-1]
+    stats["pMin"] = np.sort(pMin)
+    stats["statMax"] = np.sort(statMax)[::-1]
     alphaFWE = stats["pMin"][int(round(alpha*nperm))]
     statFWE = stats["statMax"][int(round(alpha*nperm))]
 
-    # If a cluster size is defined, also determine the significant
-    # cluster size at the specified alpha value
-    # Threshold the pvalue
-    pThresh = p < cThresh
-    pThresh = np.array(pThresh)
-
-    for ii in range(nperm):
-        # Find indices where significant clusters end.
-        # The method used requires significant p-values to be included
-        # between non-significant p-values. 0 are therefore added at
-        # both ends of the thresholded p-value vector
-        # (for cases when significant p-values are located at its ends)
-        pThresh_ii = [0] + list(pThresh[ii, :].astype(np.uint8)) + [0]
-        pThresh_ii = np.array(pThresh_ii)
-        clusEnd = np.where(pThresh_ii == 0)[0]
-        clusSiz = np.diff(clusEnd)
-        clusMax[ii] = clusSiz.max()
     # Sort the clusters in descending order of significance
     stats["clusMax"] = np.sort(clusMax)[::-1]
     clusterFWE = stats["clusMax"][int(round(alpha*nperm))]
@@ -3,6 +3,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import json
+
 import numpy as np
 from scipy import ndimage
 import random
@@ -167,65 +169,138 @@ def slice_dir_to_int(slice_dir):
     return slice_direction_int
 
 
-def sample_slices(data, seg, slice_idxs, slice_direction=0, labels_type=np.int16):
-    if slice_direction == 0:
-        x = data[slice_idxs, :, :].astype(np.float32)  # (bs, y, z, channels)
-        y = seg[slice_idxs, :, :].astype(labels_type)
-        # depth-channel has to be before width and height for Unet (but after batches)
-        x = np.array(x).transpose(0, 3, 1, 2)
-        # nr_classes channel has to be before with and height for DataAugmentation (bs, channels, x, y)
-        y = np.array(y).transpose(0, 3, 1, 2)
-    elif slice_direction == 1:
-        x = data[:, slice_idxs, :].astype(np.float32)  # (x, bs, z, channels)
-        y = seg[:, slice_idxs, :].astype(labels_type)
-        x = np.array(x).transpose(1, 3, 0, 2)
-        y = np.array(y).transpose(1, 3, 0, 2)
-    elif slice_direction == 2:
-        x = data[:, :, slice_idxs].astype(np.float32)  # (x, y, bs, channels)
-        y = seg[:, :, slice_idxs].astype(labels_type)
-        x = np.array(x).transpose(2, 3, 0, 1)
-        y = np.array(y).transpose(2, 3, 0, 1)
+def _slice_layout_axes(slice_direction):
+    other_axes = [axis for axis in range(3) if axis != slice_direction]
+    return (slice_direction, 3, other_axes[0], other_axes[1])
+
+
+def to_slice_layout(data, slice_direction=0):
+    """
+    Reorder 4D image so that each slice of the given direction is one contiguous block which already has the
+    order needed for a batch (channels, a, b). Sampling slices from this layout does not need any transposes.
+
+    Args:
+        data: 4D image [x, y, z, channels]
+        slice_direction: 0|1|2
+
+    Returns:
+        C-contiguous array [nr_slices, channels, a, b]
+    """
+    return np.ascontiguousarray(data.transpose(_slice_layout_axes(slice_direction)))
+
+
+def save_as_slices(data, path_prefix, pack_binary=True):
+    """
+    Save 4D image as uncompressed npy files which can be memory mapped: one file per slice direction
+    (<path_prefix>_x.npy, <path_prefix>_y.npy, <path_prefix>_z.npy) with shape [nr_slices, channels, a, b].
+    This way each slice is one contiguous block and loading a few slices only reads those slices from disk.
+    Binary images (e.g. bundle masks) are bit-packed along the channel dimension. Shape and dtype of the
+    original image are saved to <path_prefix>_slices.json.
+
+    Args:
+        data: 3D or 4D image [x, y, z, (channels)]
+        path_prefix: output path without file ending
+        pack_binary: bit-pack image if it only contains 0 and 1
+
+    Returns:
+        Void
+    """
+    if len(data.shape) == 3:
+        data = data[..., None]
+    packed = bool(pack_binary and np.array_equal(data, data.astype(bool)))
+    for slice_direction, axis_name in enumerate(["x", "y", "z"]):
+        slices = to_slice_layout(data, slice_direction)
+        if packed:
+            slices = np.packbits(slices.astype(bool), axis=1)
+        np.save(path_prefix + "_" + axis_name + ".npy", slices)
+    with open(path_prefix + "_slices.json", "w") as f:
+        json.dump({"shape": list(data.shape), "dtype": data.dtype.name, "packed": packed}, f)
+
+
+def load_slices_meta(path_prefix):
+    """
+    Load shape, dtype and packing information of files created by save_as_slices().
+    """
+    with open(path_prefix + "_slices.json") as f:
+        return json.load(f)
+
+
+def load_slices(path_prefix, slice_idxs, slice_direction=0):
+    """
+    Load slices from files created by save_as_slices(). Only the selected slices are read from disk.
+
+    Args:
+        path_prefix: path without file ending
+        slice_idxs: indices of slices to load
+        slice_direction: 0|1|2
+
+    Returns:
+        slices with shape [len(slice_idxs), channels, a, b]
+    """
+    meta = load_slices_meta(path_prefix)
+    axis_name = ["x", "y", "z"][slice_direction]
+    slices = np.load(path_prefix + "_" + axis_name + ".npy", mmap_mode="r")[slice_idxs]
+    if meta["packed"]:
+        slices = np.unpackbits(slices, axis=1, count=meta["shape"][3]).astype(meta["dtype"])
+    return slices
+
+
+def sample_slices(data, seg, slice_idxs, slice_direction=0, labels_type=np.int16, slice_layout=False):
+    """
+    Sample 2D slices.
+
+    Args:
+        data: 4D image [x, y, z, channels] or [nr_slices, channels, a, b] if slice_layout
+        seg: 4D labels [x, y, z, nr_classes] or [nr_slices, nr_classes, a, b] if slice_layout
+        slice_idxs: indices of slices
+        slice_direction: 0|1|2
+        labels_type: dtype of returned labels
+        slice_layout: data and seg already are in the layout returned by to_slice_layout() for slice_direction
+
+    Returns:
+        data [bs, channels, a, b] and labels [bs, nr_classes, a, b]
+    """
+    if not slice_layout:
+        # Indexing the transposed view directly gathers the slices in (bs, channels, a, b) order with one copy
+        data = data.transpose(_slice_layout_axes(slice_direction))
+        seg = seg.transpose(_slice_layout_axes(slice_direction))
+    x = data[slice_idxs].astype(np.float32, copy=False)
+    y = seg[slice_idxs].astype(labels_type, copy=False)
     return x, y
 
 
-def sample_Xslices(data, seg, slice_idxs, slice_direction=0, labels_type=np.int16, slice_window=5):
+def sample_Xslices(data, seg, slice_idxs, slice_direction=0, labels_type=np.int16, slice_window=5,
+                   slice_layout=False):
     """
-    Sample slices but add slices_window/2 above and below.
+    Sample slices but add slices_window/2 above and below. Slices outside of the image are filled with 0.
+
+    Args:
+        data: 4D image [x, y, z, channels] or [nr_slices, channels, a, b] if slice_layout
+        seg: 4D labels [x, y, z, nr_classes] or [nr_slices, nr_classes, a, b] if slice_layout
+        slice_idxs: indices of slices
+        slice_direction: 0|1|2
+        labels_type: dtype of returned labels
+        slice_window: nr of slices per sample (only odd numbers allowed)
+        slice_layout: data and seg already are in the layout returned by to_slice_layout() for slice_direction
+
+    Returns:
+        data [bs, slice_window*channels, a, b] and labels of center slices [bs, nr_classes, a, b]
     """
-    sw = slice_window  # slice_window (only odd numbers allowed)
+    sw = slice_window
     assert sw % 2 == 1, "Slice_window has to be an odd number"
     pad = int((sw - 1) / 2)
 
-    if slice_direction == 0:
-        y = seg[slice_idxs, :, :].astype(labels_type)
-        y = np.array(y).transpose(0, 3, 1, 2)  # nr_classes channel has to be before with and height for DataAugmentation (bs, nr_of_classes, x, y)
-    elif slice_direction == 1:
-        y = seg[:, slice_idxs, :].astype(labels_type)
-        y = np.array(y).transpose(1, 3, 0, 2)
-    elif slice_direction == 2:
-        y = seg[:, :, slice_idxs].astype(labels_type)
-        y = np.array(y).transpose(2, 3, 0, 1)
-
-    data_pad = np.zeros((data.shape[0] + sw - 1, data.shape[1] + sw - 1, data.shape[2] + sw - 1, data.shape[3])).astype(
-        data.dtype)
-    data_pad[pad:-pad, pad:-pad, pad:-pad, :] = data  # padded with two slices of zeros on all sides
-    batch = []
-    for s_idx in slice_idxs:
-        if slice_direction == 0:
-            # (s_idx+2)-2:(s_idx+2)+3 = s_idx:s_idx+5
-            x = data_pad[s_idx:s_idx + sw:, pad:-pad, pad:-pad, :].astype(np.float32)  # (5, y, z, channels)
-            x = np.array(x).transpose(0, 3, 1, 2)  # channels dim has to be before width and height for Unet (but after batches)
-            x = np.reshape(x, (x.shape[0] * x.shape[1], x.shape[2], x.shape[3]))  # (5*channels, y, z)
-            batch.append(x)
-        elif slice_direction == 1:
-            x = data_pad[pad:-pad, s_idx:s_idx + sw, pad:-pad, :].astype(np.float32)  # (5, y, z, channels)
-            x = np.array(x).transpose(1, 3, 0, 2)
-            x = np.reshape(x, (x.shape[0] * x.shape[1], x.shape[2], x.shape[3]))  # (5*channels, y, z)
-            batch.append(x)
-        elif slice_direction == 2:
-            x = data_pad[pad:-pad, pad:-pad, s_idx:s_idx + sw, :].astype(np.float32)  # (5, y, z, channels)
-            x = np.array(x).transpose(2, 3, 0, 1)
-            x = np.reshape(x, (x.shape[0] * x.shape[1], x.shape[2], x.shape[3]))  # (5*channels, y, z)
-            batch.append(x)
-
-    return np.array(batch), y  # (bs, channels, x, y)
+    if not slice_layout:
+        data = data.transpose(_slice_layout_axes(slice_direction))
+        seg = seg.transpose(_slice_layout_axes(slice_direction))
+    nr_slices = data.shape[0]
+
+    # Instead of padding the entire image, clip the window indices and set slices outside of the image to 0
+    window_idxs = np.asarray(slice_idxs)[:, None] + np.arange(-pad, pad + 1)[None, :]  # (bs, sw)
+    outside = (window_idxs < 0) | (window_idxs >= nr_slices)
+    x = data[np.clip(window_idxs, 0, nr_slices - 1)].astype(np.float32, copy=False)  # (bs, sw, channels, a, b)
+    x[outside] = 0
+    x = x.reshape((x.shape[0], sw * x.shape[2]) + x.shape[3:])  # (bs, sw*channels, a, b)
+
+    y = seg[slice_idxs].astype(labels_type, copy=False)
+    return x, y
@@ -12,6 +12,7 @@ from os.path import join
 from pprint import pprint
 
 import numpy as np
+import psutil
 
 from tractseg.libs.system_config import SystemConfig as C
 
@@ -180,3 +181,32 @@ def load_config_from_txt(path):
     config_dict = ast.literal_eval(clean_str)
     config_obj = Struct(**config_dict)
     return config_obj
+
+
+def get_nr_available_cpus():
+    """
+    Get the number of CPUs this process can use. Other than psutil.cpu_count() this takes the CPU affinity and
+    the cgroup CPU quota into account (e.g. the cores assigned on a cluster node or in a docker container).
+
+    Returns:
+        number of CPUs (int)
+    """
+    try:
+        nr_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on Mac and Windows
+        nr_cpus = psutil.cpu_count()
+
+    try:
+        if os.path.exists("/sys/fs/cgroup/cpu.max"):  # cgroup v2: "<quota> <period>"
+            with open("/sys/fs/cgroup/cpu.max") as f:
+                quota, period = f.read().split()
+        else:  # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = f.read().strip()
+        if quota not in ["max", "-1"]:
+            nr_cpus = min(nr_cpus, max(1, int(np.ceil(int(quota) / float(period)))))
+    except (IOError, OSError, ValueError):
+        pass
+    return nr_cpus
@@ -3,78 +3,381 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import atexit
 import multiprocessing
-from os import getpid
 import numpy as np
 import nibabel as nib
+from nibabel.affines import apply_affine
+from nibabel.streamlines import trk
+from joblib import Parallel, delayed
 from dipy.tracking.streamline import compress_streamlines as compress_streamlines_dipy
-from dipy.segment.metric import ResampleFeature
 from dipy.tracking.metrics import spline
 from dipy.tracking import utils as utils_trk
 from dipy.tracking.streamline import transform_streamlines
 from dipy.tracking.streamline import set_number_of_points
 from dipy.tracking.streamline import length as sl_length
+from dipy.tracking.streamline import Streamlines
 
 from tractseg.libs import utils
 from tractseg.libs import peak_utils
 
-# Global variables needed for shared memory of parallel fiber compression
-global _COMPRESSION_ERROR_THRESHOLD
-_COMPRESSION_ERROR_THRESHOLD = None
-global _FIBER_BATCHES
-_FIBER_BATCHES = None
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8 -> always compress in process
+    shared_memory = None
 
+# Long-lived pool for parallel fiber compression (created on first use and reused for all following bundles)
+_COMPRESSION_POOL = None
+_COMPRESSION_POOL_SIZE = None
 
-def compress_fibers_worker_shared_mem(idx):
+# For fewer points compressing in the main process is faster than distributing the work to the pool
+_MIN_POINTS_FOR_PARALLEL_COMPRESSION = 200000
+
+_TRK_HEADER_SIZE = 1000
+
+
+def as_streamlines(streamlines):
+    """
+    Return streamlines as Streamlines object (= nibabel ArraySequence). All points are stored in one flat
+    (nr_points_total, 3) array plus the offset and length of each streamline. This avoids one python object per
+    streamline and allows to process all points at once.
+
+    Args:
+        streamlines: list of streamlines or Streamlines object
+
+    Returns:
+        Streamlines object (no copy if input already is a Streamlines object)
+    """
+    if isinstance(streamlines, Streamlines):
+        return streamlines
+    return Streamlines(streamlines)
+
+
+def _check_flat_layout():
+    """
+    Check if nibabel's ArraySequence stores the streamlines in the layout get_flat_data and from_flat_data access
+    directly (_data, _offsets, _lengths; tested with nibabel 3.2). These attributes are not part of the public
+    API. If they change the slower public API is used.
+    """
+    try:
+        points = np.arange(15, dtype=np.float32).reshape(5, 3)
+        reference = Streamlines([points[:2], points[2:]])
+        if not (np.array_equal(reference._data, points) and np.array_equal(reference._offsets, [0, 2]) and
+                np.array_equal(reference._lengths, [2, 3])):
+            return False
+        streamlines = Streamlines()
+        streamlines._data = points
+        streamlines._offsets = np.array([0, 2])
+        streamlines._lengths = np.array([2, 3])
+        return len(streamlines) == 2 and all(np.array_equal(sl, sl_ref) for sl, sl_ref in zip(streamlines, reference))
+    except Exception:
+        return False
+
+
+_FLAT_LAYOUT = _check_flat_layout()
+
+
+def get_flat_data(streamlines):
+    """
+    Get the flat point buffer of streamlines. If streamlines is a view (e.g. result of slicing) only containing a
+    part of the buffer a compact copy is created.
+
+    Args:
+        streamlines: list of streamlines or Streamlines object
+
+    Returns:
+        (points [nr_points_total, 3], offsets [nr_streamlines], lengths [nr_streamlines])
+    """
+    streamlines = as_streamlines(streamlines)
+    if len(streamlines) == 0:
+        return np.zeros((0, 3), dtype=np.float32), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if not _FLAT_LAYOUT:
+        lengths = np.array([len(sl) for sl in streamlines], dtype=np.int64)
+        return np.concatenate(list(streamlines)), np.cumsum(lengths) - lengths, lengths
+    lengths = np.asarray(streamlines._lengths, dtype=np.int64)
+    offsets = np.asarray(streamlines._offsets, dtype=np.int64)
+    offsets_compact = np.cumsum(lengths) - lengths
+    if len(streamlines._data) == lengths.sum() and np.array_equal(offsets, offsets_compact):
+        return streamlines._data, offsets, lengths
+    idxs = np.arange(lengths.sum()) + np.repeat(offsets - offsets_compact, lengths)
+    return streamlines._data[idxs], offsets_compact, lengths
+
+
+def from_flat_data(points, lengths):
+    """
+    Create Streamlines object from flat point buffer (no copy).
+
+    Args:
+        points: [nr_points_total, 3]
+        lengths: number of points of each streamline [nr_streamlines]
+
+    Returns:
+        Streamlines object
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    streamlines = Streamlines()
+    if len(lengths) > 0:
+        if _FLAT_LAYOUT:
+            streamlines._data = points
+            streamlines._offsets = offsets
+            streamlines._lengths = lengths
+        else:
+            for offset, length in zip(offsets, lengths):
+                streamlines.append(points[offset:offset + length], cache_build=True)
+            streamlines.finalize_append()
+    return streamlines
+
+
+def _get_compression_pool(nr_processes):
+    global _COMPRESSION_POOL
+    global _COMPRESSION_POOL_SIZE
+    if _COMPRESSION_POOL is None or _COMPRESSION_POOL_SIZE != nr_processes:
+        _close_compression_pool()
+        _COMPRESSION_POOL = multiprocessing.Pool(processes=nr_processes)
+        _COMPRESSION_POOL_SIZE = nr_processes
+    return _COMPRESSION_POOL
+
+
+@atexit.register
+def _close_compression_pool():
+    global _COMPRESSION_POOL
+    if _COMPRESSION_POOL is not None:
+        _COMPRESSION_POOL.close()
+        _COMPRESSION_POOL.join()
+        _COMPRESSION_POOL = None
+
+
+def _compress_flat(points, offsets, lengths, error_threshold):
+    """
+    Compress streamlines given as flat point buffer.
+
+    Returns:
+        (compressed points [nr_points_compressed, 3], lengths of compressed streamlines)
+    """
+    if len(lengths) == 0:
+        return np.zeros((0, 3), dtype=points.dtype), np.zeros(0, dtype=np.int64)
+    streamlines_c = compress_streamlines_dipy([points[offset:offset + length]
+                                               for offset, length in zip(offsets, lengths)],
+                                              tol_error=error_threshold)
+    lengths_c = np.array([len(sl) for sl in streamlines_c], dtype=np.int64)
+    return np.concatenate(streamlines_c).astype(points.dtype), lengths_c
+
+
+def compress_fibers_worker_shared_mem(shm_name, shape, dtype, offsets, lengths, error_threshold):
     """
     Worker Functions for multithreaded compression.
 
     Function that runs in parallel must be on top level (not in class/function) otherwise it can
     not be pickled.
+
+    Only the name of the shared memory block and the offsets of the chunk of streamlines this worker is
+    responsible for are passed in. The points are read directly from shared memory.
     """
-    streamlines_chunk = _FIBER_BATCHES[idx]  # shared memory; by using indices each worker accesses only his part
-    result = compress_streamlines_dipy(streamlines_chunk, tol_error=_COMPRESSION_ERROR_THRESHOLD)
-    # print('PID {}, DONE'.format(getpid()))
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        points = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = _compress_flat(points, offsets, lengths, error_threshold)  # copy -> independent of shm
+        del points  # no references to shm buffer allowed when closing
+    finally:
+        shm.close()
     return result
 
 
 def compress_streamlines(streamlines, error_threshold=0.1, nr_cpus=-1):
+    """
+    Compress streamlines (in parallel if bundle is big enough).
+
+    Args:
+        streamlines: list of streamlines or Streamlines object
+        error_threshold: tolerance error in mm
+        nr_cpus: number of processes to use. -1 means all available CPUs.
+
+    Returns:
+        Streamlines object
+    """
     import psutil
-    if nr_cpus == -1:
-        nr_processes = psutil.cpu_count()
-    else:
-        nr_processes = nr_cpus
-    number_streamlines = len(streamlines)
+    nr_processes = psutil.cpu_count() if nr_cpus == -1 else nr_cpus
+    points, offsets, lengths = get_flat_data(streamlines)
+    nr_processes = min(nr_processes, len(lengths))
+
+    if shared_memory is None or nr_processes <= 1 or len(points) < _MIN_POINTS_FOR_PARALLEL_COMPRESSION:
+        return from_flat_data(*_compress_flat(points, offsets, lengths, error_threshold))
+
+    # Do not pass in data (doubles amount of memory needed and pickling is slow), but only put the flat point
+    #  buffer into shared memory once and pass the offsets of the chunks to the workers
+    points = np.ascontiguousarray(points)
+    shm = shared_memory.SharedMemory(create=True, size=points.nbytes)
+    try:
+        points_shared = np.ndarray(points.shape, dtype=points.dtype, buffer=shm.buf)
+        points_shared[:] = points
+        del points_shared
+
+        chunks = np.array_split(np.arange(len(lengths)), nr_processes)
+        result = _get_compression_pool(nr_processes).starmap(
+            compress_fibers_worker_shared_mem,
+            [(shm.name, points.shape, points.dtype, offsets[chunk], lengths[chunk], error_threshold)
+             for chunk in chunks])
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return from_flat_data(np.concatenate([points_c for points_c, lengths_c in result]),
+                          np.concatenate([lengths_c for points_c, lengths_c in result]))
+
+
+def _write_trk_flat(out_file, header, points, lengths):
+    """
+    Write streamlines in trk format. All records (nr of points as int32 followed by the points as float32) are
+    assembled in one buffer which is written in one go instead of one write per streamline.
+
+    Args:
+        out_file: string with filepath of the output file
+        header: trk header as numpy structured array (1000 bytes)
+        points: flat point buffer [nr_points_total, 3] already in trackvis voxmm space
+        lengths: number of points of each streamline [nr_streamlines]
+
+    Returns:
+        void
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    nr_streamlines = len(lengths)
+    record_lengths = 3 * lengths + 1
+    record_starts = np.cumsum(record_lengths) - record_lengths
+    buffer = np.empty(int(record_lengths.sum()), dtype="<f4")
+    buffer.view("<i4")[record_starts] = lengths
+    coord_idxs = np.arange(3 * int(lengths.sum())) + np.repeat(np.arange(1, nr_streamlines + 1), 3 * lengths)
+    buffer[coord_idxs] = np.asarray(points, dtype=np.float32).ravel()
+    with open(out_file, "wb") as f:
+        f.write(header.tobytes() + buffer.tobytes())
+
+
+def _read_trk_flat(file_in):
+    """
+    Read streamlines from trk file into flat point buffer (points as stored in the file, i.e. trackvis voxmm space).
 
-    if nr_processes >= number_streamlines:
-        nr_processes = number_streamlines - 1
-        if nr_processes < 1:
-            nr_processes = 1
+    Args:
+        file_in: path of trk file
 
-    chunk_size = int(number_streamlines / nr_processes)
+    Returns:
+        (header, points [nr_points_total, 3], lengths [nr_streamlines])
+    """
+    header = np.fromfile(file_in, dtype=trk.header_2_dtype, count=1)[0]
+    if header['hdr_size'] != _TRK_HEADER_SIZE:
+        raise ValueError("Only little endian trk files are supported: {}".format(file_in))
+    nr_scalars = int(header['nb_scalars_per_point'])
+    nr_properties = int(header['nb_properties_per_streamline'])
+
+    data = np.fromfile(file_in, dtype="<f4", offset=_TRK_HEADER_SIZE)
+    nr_points = data.view("<i4")
+
+    # Records have variable length -> only the start of each record has to be found sequentially
+    point_size = 3 + nr_scalars
+    starts = []
+    lengths = []
+    pos = 0
+    while pos < len(data):
+        length = int(nr_points[pos])
+        starts.append(pos + 1)
+        lengths.append(length)
+        pos += 1 + length * point_size + nr_properties
+    starts = np.array(starts, dtype=np.int64)
+    lengths = np.array(lengths, dtype=np.int64)
 
-    if chunk_size < 1:
-        return streamlines
-    fiber_batches = list(utils.chunks(streamlines, chunk_size))
+    offsets = np.cumsum(lengths) - lengths
+    point_idxs = np.repeat(starts, lengths) + (np.arange(lengths.sum()) - np.repeat(offsets, lengths)) * point_size
+    points = data[point_idxs[:, None] + np.arange(3)]
+    return header, points, lengths
 
-    global _COMPRESSION_ERROR_THRESHOLD
-    global _FIBER_BATCHES
-    _COMPRESSION_ERROR_THRESHOLD = error_threshold
-    _FIBER_BATCHES = fiber_batches
 
-    # print("Main program using: {} GB".format(round(Utils.mem_usage(print_usage=False), 3)))
-    pool = multiprocessing.Pool(processes=nr_processes)
+def _write_tck_flat(out_file, points, lengths):
+    """
+    Write streamlines in MRtrix tck format (points as float32 triplets, streamlines separated by NaN triplets and
+    file terminated by Inf triplet). All points are assembled in one buffer which is written in one go.
 
-    #Do not pass in data (doubles amount of memory needed), but only idx of shared memory
-    #  (needs only as much memory as single thread version (only main thread needs memory, others almost 0).
-    #  Shared memory version also faster (around 20-30%?).
-    result = pool.map(compress_fibers_worker_shared_mem, range(0, len(fiber_batches)))
+    Args:
+        out_file: string with filepath of the output file
+        points: flat point buffer [nr_points_total, 3] in RASmm
+        lengths: number of points of each streamline [nr_streamlines]
 
-    pool.close()
-    pool.join()
+    Returns:
+        void
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    nr_streamlines = len(lengths)
+    buffer = np.full((int(lengths.sum()) + nr_streamlines + 1, 3), np.nan, dtype="<f4")
+    buffer[np.arange(lengths.sum()) + np.repeat(np.arange(nr_streamlines), lengths)] = points
+    buffer[-1] = np.inf
 
-    streamlines_c = utils.flatten(result)
-    return streamlines_c
+    header = "mrtrix tracks\ncount: {:010}\ndatatype: Float32LE\nfile: . ".format(nr_streamlines)
+    # Offset of the data has to contain the length of its own string representation
+    data_offset = len(header) + len("\nEND\n")
+    while data_offset != len(header) + len(str(data_offset)) + len("\nEND\n"):
+        data_offset = len(header) + len(str(data_offset)) + len("\nEND\n")
+    header += "{}\nEND\n".format(data_offset)
+
+    with open(out_file, "wb") as f:
+        f.write(header.encode("latin1") + buffer.tobytes())
+
+
+def _read_tck_flat(file_in):
+    """
+    Read streamlines from tck file into flat point buffer.
+
+    Args:
+        file_in: path of tck file
+
+    Returns:
+        (points [nr_points_total, 3], lengths [nr_streamlines])
+    """
+    fields = {}
+    with open(file_in, "rb") as f:
+        if f.readline().strip() != b"mrtrix tracks":
+            raise ValueError("Not a valid tck file: {}".format(file_in))
+        for line in f:
+            line = line.decode("latin1").strip()
+            if line == "END":
+                break
+            key, value = line.split(":", 1)
+            fields[key.strip()] = value.strip()
+
+    dtypes = {"Float32LE": "<f4", "Float32BE": ">f4", "Float64LE": "<f8", "Float64BE": ">f8"}
+    data_offset = int(fields["file"].split()[1])
+    data = np.fromfile(file_in, dtype=dtypes[fields["datatype"]], offset=data_offset)
+    data = data[:len(data) // 3 * 3].reshape(-1, 3)
+
+    end = np.flatnonzero(np.isinf(data[:, 0]))
+    if len(end) > 0:
+        data = data[:end[0]]
+    separators = np.flatnonzero(np.isnan(data[:, 0]))
+    lengths = np.diff(np.concatenate([[-1], separators])) - 1
+    # Points after the last separator belong to an incomplete streamline (e.g. tracking still running)
+    data = data[:separators[-1]] if len(separators) > 0 else data[:0]
+    points = data[~np.isnan(data[:, 0])].astype(np.float32)
+    return points, lengths.astype(np.int64)
+
+
+def load_streamlines(file_in, tracking_format="trk_legacy"):
+    """
+    Load streamlines from trk or tck file directly into a flat point buffer (without creating one python object per
+    streamline).
+
+    Args:
+        file_in: path of trk or tck file
+        tracking_format: trk_legacy | trk | tck. For trk_legacy the points are returned as stored in the file
+            (coordinate space, like nib.trackvis.read). For trk and tck the points are returned in RASmm (like
+            nib.streamlines.load).
+
+    Returns:
+        Streamlines object
+    """
+    if file_in.endswith(".tck"):
+        points, lengths = _read_tck_flat(file_in)
+    else:
+        header, points, lengths = _read_trk_flat(file_in)
+        if tracking_format != "trk_legacy":
+            points = apply_affine(trk.get_affine_trackvis_to_rasmm(header), points).astype(np.float32)
+    return from_flat_data(points, lengths)
 
 
 def save_streamlines_as_trk_legacy(out_file, streamlines, affine, shape):
@@ -101,8 +404,13 @@ def save_streamlines_as_trk_legacy(out_file, streamlines, affine, shape):
     trackvis_header['voxel_order'] = 'RAS'
     trackvis_header['dim'] = shape
     nib.trackvis.aff_to_hdr(affine, trackvis_header, pos_vox=False, set_order=False)
-    streamlines_trk_format = [(sl, None, None) for sl in streamlines]
-    nib.trackvis.write(out_file, streamlines_trk_format, trackvis_header, points_space="rasmm")
+
+    # Same transformation as nib.trackvis.write(..., points_space="rasmm") but applied to all points at once
+    points, offsets, lengths = get_flat_data(streamlines)
+    vx2tv = np.diag(trackvis_header['voxel_size'].tolist() + [1])
+    mm2tv = np.dot(vx2tv, np.linalg.inv(trackvis_header['vox_to_ras'])).astype(np.float32)
+    trackvis_header['n_count'] = len(lengths)
+    _write_trk_flat(out_file, trackvis_header, apply_affine(mm2tv, points), lengths)
 
 
 def save_streamlines(out_file, streamlines, affine=None, shape=None, vox_sizes=None, vox_order='RAS'):
@@ -116,8 +424,8 @@ def save_streamlines(out_file, streamlines, affine=None, shape=None, vox_sizes=N
                                       [   0.  ,    0.  ,    1.25,  -72.  ],
                                       [   0.  ,    0.  ,    0.  ,    1.  ]],
                                      dtype=float32)
-    Uses the new nib.streamlines API (streamlines are saved in voxel space and affine is applied to transform them to
-    coordinate space).
+    Uses the convention of the new nib.streamlines API (streamlines are saved in voxel space and affine is applied to
+    transform them to coordinate space). The file is written directly from the flat point buffer.
 
     todo: use dipy.io.streamline.save_tractogram to save streamlines
 
@@ -145,27 +453,34 @@ def save_streamlines(out_file, streamlines, affine=None, shape=None, vox_sizes=N
     if vox_sizes is None:
         vox_sizes = np.array([abs(affine[0,0]), abs(affine[1,1]), abs(affine[2,2])], dtype=np.float32)
 
-    # Create a new header with the correct affine and nr of streamlines
-    hdr = {}
+    points, offsets, lengths = get_flat_data(streamlines)
+
+    if out_file.endswith(".tck"):
+        # tck always stores the streamlines in RASmm
+        _write_tck_flat(out_file, points, lengths)
+        return
+
+    # Create a new header with the correct affine and nr of streamlines (same defaults as nib.streamlines.TrkFile)
+    hdr = np.zeros((), dtype=trk.header_2_dtype)
+    hdr['magic_number'] = b"TRACK"
     hdr['voxel_sizes'] = vox_sizes
     hdr['voxel_order'] = vox_order
     hdr['dimensions'] = shape
     hdr['voxel_to_rasmm'] = affine
-    hdr['nb_streamlines'] = len(streamlines)
+    hdr['nb_streamlines'] = len(lengths)
+    hdr['version'] = 2
+    hdr['hdr_size'] = _TRK_HEADER_SIZE
 
-    nib.streamlines.save(nib.streamlines.Tractogram(streamlines, affine_to_rasmm=np.eye(4)), out_file, header=hdr)
+    _write_trk_flat(out_file, hdr, apply_affine(trk.get_affine_rasmm_to_trackvis(hdr), points), lengths)
 
 
 def convert_tck_to_trk(filename_in, filename_out, reference_affine, reference_shape,
                        compress_err_thr=0.1, smooth=None, nr_cpus=-1, tracking_format="trk_legacy"):
 
-    streamlines = nib.streamlines.load(filename_in).streamlines  # Load Fibers (Tck)
+    streamlines = load_streamlines(filename_in, tracking_format="tck")  # Load Fibers (Tck)
 
     if smooth is not None:
-        streamlines_smooth = []
-        for sl in streamlines:
-            streamlines_smooth.append(spline(sl, s=smooth))
-        streamlines = streamlines_smooth
+        streamlines = smooth_streamlines(streamlines, smoothing_factor=smooth, nr_cpus=nr_cpus)
 
     #Compressing also good to remove checkerboard artefacts from tracking on peaks
     if compress_err_thr is not None:
@@ -182,7 +497,7 @@ def create_empty_tractogram(filename_out, reference_file,
 
     ref_img = nib.load(reference_file)
     reference_affine = ref_img.affine
-    reference_shape = ref_img.get_data().shape[:3]
+    reference_shape = ref_img.shape[:3]
 
     streamlines = []
 
@@ -193,28 +508,46 @@ def create_empty_tractogram(filename_out, reference_file,
 
 
 def resample_fibers(streamlines, nb_points=12):
-    streamlines_new = []
-    for sl in streamlines:
-        feature = ResampleFeature(nb_points=nb_points)
-        streamlines_new.append(feature.extract(sl))
-    return streamlines_new
+    """
+    Resample each streamline to nb_points equidistant points.
+
+    Args:
+        streamlines: list of streamlines or Streamlines object
+        nb_points: number of points of each resampled streamline
 
+    Returns:
+        Streamlines object
+    """
+    # On a Streamlines object dipy resamples the whole flat point buffer in one compiled call (no python object
+    # and no ResampleFeature per streamline)
+    return set_number_of_points(as_streamlines(streamlines), nb_points=nb_points)
 
-def smooth_streamlines(streamlines, smoothing_factor=10):
+
+def smooth_streamlines(streamlines, smoothing_factor=10, nr_cpus=-1):
     """
     Smooth streamlines
 
     Args:
         streamlines: list of streamlines
         smoothing_factor: 10: slight smoothing,  100: very smooth from beginning to end
+        nr_cpus: number of threads to use. -1 means all available CPUs.
 
     Returns:
         smoothed streamlines
     """
-    streamlines_smooth = []
-    for sl in streamlines:
-        streamlines_smooth.append(spline(sl, s=smoothing_factor))
-    return streamlines_smooth
+    def _smooth_chunk(streamlines_chunk):
+        return [spline(sl, s=smoothing_factor) for sl in streamlines_chunk]
+
+    if len(streamlines) == 0:
+        return as_streamlines(streamlines)
+
+    import psutil
+    nr_threads = psutil.cpu_count() if nr_cpus == -1 else nr_cpus
+    chunk_size = int(np.ceil(len(streamlines) / float(nr_threads)))
+    # Threads instead of processes: streamlines do not have to be pickled and spline fitting runs in compiled code
+    streamlines_smooth = Parallel(n_jobs=nr_threads, prefer="threads")(
+        delayed(_smooth_chunk)(chunk) for chunk in utils.chunks(streamlines, chunk_size))
+    return as_streamlines(utils.flatten(streamlines_smooth))
 
 
 def get_streamline_statistics(streamlines, subsample=False, raw=False):
@@ -234,17 +567,9 @@ def get_streamline_statistics(streamlines, subsample=False, raw=False):
     else:
         STEP_SIZE = 1
 
-    lengths = []
-    spaces = []  # spaces between 2 points
-    for j in range(0, len(streamlines), STEP_SIZE):
-        sl = streamlines[j]
-        length = 0
-        for i in range(len(sl)):
-            if i < (len(sl)-1):
-                space = np.linalg.norm(sl[i+1] - sl[i])
-                spaces.append(space)
-                length += space
-        lengths.append(length)
+    points, offsets, sl_lengths = get_flat_data(as_streamlines(streamlines)[::STEP_SIZE])
+    spaces, sl_idxs = _get_segment_lengths(points, sl_lengths)  # spaces between 2 points
+    lengths = np.bincount(sl_idxs, weights=spaces, minlength=len(sl_lengths))
 
     if raw:
         return lengths, spaces
@@ -252,21 +577,76 @@ def get_streamline_statistics(streamlines, subsample=False, raw=False):
         return np.array(lengths).mean(), np.array(spaces).mean(), np.array(spaces).max()
 
 
+def _get_segment_lengths(points, lengths):
+    """
+    Length of all segments (space between 2 following points) of all streamlines in a flat point buffer.
+
+    Returns:
+        (segment lengths, index of the streamline each segment belongs to)
+    """
+    if len(lengths) == 0 or lengths.sum() < 2:
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+    spaces = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    sl_idxs = np.repeat(np.arange(len(lengths)), lengths)[:-1]
+    # remove segments between last point of one streamline and first point of next streamline
+    is_segment = np.ones(len(spaces), dtype=bool)
+    is_segment[(np.cumsum(lengths) - 1)[:-1]] = False
+    return spaces[is_segment], sl_idxs[is_segment]
+
+
+def _subsegment_flat(points, offsets, lengths, max_segment_length):
+    """
+    Same as dipy.tracking.utils.subsegment but for all streamlines at once: every segment is split into
+    ceil(segment_length / max_segment_length) equally long subsegments.
+
+    Returns:
+        (points [nr_points_total_new, 3], lengths [nr_streamlines])
+    """
+    points = points.astype(np.float64)
+    is_first = np.zeros(len(points), dtype=bool)
+    is_first[offsets] = True
+    has_segment = np.ones(len(points), dtype=bool)
+    has_segment[offsets + lengths - 1] = False
+
+    # diffs[i] = segment from point i to point i+1 (zero if point i is the last point of a streamline)
+    diffs = np.zeros_like(points)
+    diffs[:-1] = np.diff(points, axis=0)
+    diffs[~has_segment] = 0
+    nr_subsegments = np.ceil(np.sqrt((diffs ** 2).sum(axis=1)) / max_segment_length).astype(np.int64)
+
+    # Each point emits its subsegment end points, the first point of a streamline additionally emits itself
+    nr_new_points = nr_subsegments + is_first
+    src_idxs = np.repeat(np.arange(len(points)), nr_new_points)
+    new_offsets = np.cumsum(nr_new_points) - nr_new_points
+    steps = np.arange(len(src_idxs)) - np.repeat(new_offsets, nr_new_points) + ~is_first[src_idxs]
+    fractions = steps / np.maximum(nr_subsegments[src_idxs], 1)
+    points_new = points[src_idxs] + diffs[src_idxs] * fractions[:, None]
+    return points_new, np.add.reduceat(nr_new_points, offsets)
+
+
 def filter_streamlines_leaving_mask(streamlines, mask):
     """
-    Remove all streamlines that exit the mask
+    Remove all streamlines that exit the mask. Streamlines are subsegmented to 0.1 voxel spacing and the mask is
+    looked up for all points at once.
+
+    Args:
+        streamlines: streamlines in voxel space
+        mask: binary 3D mask
+
+    Returns:
+        Streamlines object with the subsegmented streamlines which stay inside the mask
     """
     max_seq_len = 0.1
-    streamlines = list(utils_trk.subsegment(streamlines, max_seq_len))
-
-    new_str_idxs = []
-    for i, streamline in enumerate(streamlines):
-        new_str_idxs.append(i)
-        for point in streamline:
-            if mask[int(point[0]), int(point[1]), int(point[2])] == 0:
-                new_str_idxs.pop()
-                break
-    return [streamlines[idx] for idx in new_str_idxs]
+    points, offsets, lengths = get_flat_data(streamlines)
+    if len(lengths) == 0:
+        return Streamlines()
+    points, lengths = _subsegment_flat(points, offsets, lengths, max_seq_len)
+    streamlines = from_flat_data(points, lengths)
+
+    voxel_idxs = points.astype(np.int64)
+    inside = (mask[voxel_idxs[:, 0], voxel_idxs[:, 1], voxel_idxs[:, 2]] != 0).astype(np.uint8)
+    keep = np.minimum.reduceat(inside, np.cumsum(lengths) - lengths).astype(bool)
+    return streamlines[np.flatnonzero(keep)]
 
 
 def get_best_original_peaks(peaks_pred, peaks_orig, peak_len_thr=0.1):
@@ -327,44 +707,64 @@ def get_weighted_mean_of_peaks(best_orig, tom, weight=0.5):
     return np.average(stacked, axis=0, weights=[1 - weight, weight])
 
 
+def orient_to_same_start_region(streamlines, beginnings):
+    """
+    Flip all streamlines which do not start in the beginnings region, so that all streamlines start in the same
+    region. The start points of all streamlines are looked up in the mask at once and the flipping is done on the
+    flat point buffer.
+
+    (we could also use dipy.tracking.streamline.orient_by_streamline instead)
+
+    Args:
+        streamlines: streamlines in voxel space
+        beginnings: binary mask of the beginnings region
+
+    Returns:
+        Streamlines object
+    """
+    points, offsets, lengths = get_flat_data(streamlines)
+    if len(lengths) == 0:
+        return Streamlines()
+
+    # +0.5: voxel index of the voxel containing the start point (voxel centers are at integer coordinates)
+    start_voxels = (points[offsets] + 0.5).astype(np.int64)
+    flip_sl = beginnings[start_voxels[:, 0], start_voxels[:, 1], start_voxels[:, 2]] == 0
+
+    # Reverse the order of the points inside each streamline that has to be flipped
+    point_flip = np.repeat(flip_sl, lengths)
+    idxs = np.arange(len(points))
+    idxs[point_flip] = np.repeat(2 * offsets + lengths - 1, lengths)[point_flip] - idxs[point_flip]
+    return from_flat_data(points[idxs], lengths)
+
+
 def add_to_each_streamline(streamlines, scalar):
     """
     Add scalar value to each coordinate of each streamline
     """
-    sl_new = []
-    for sl in streamlines:
-        sl_new.append(np.array(sl) + scalar)
-    return sl_new
+    points, offsets, lengths = get_flat_data(streamlines)
+    return from_flat_data(points + scalar, lengths)
 
 
 def add_to_each_streamline_axis(streamlines, scalar, axis="x"):
-    sl_new = []
-    for sl in streamlines:
-        s = np.array(sl)
-        if axis == "x":
-            s[:, 0] += scalar
-        elif axis == "y":
-            s[:, 1] += scalar
-        elif axis == "z":
-            s[:, 2] += scalar
-        sl_new.append(s)
-    return sl_new
+    points, offsets, lengths = get_flat_data(streamlines)
+    points = np.array(points)
+    if axis == "x":
+        points[:, 0] += scalar
+    elif axis == "y":
+        points[:, 1] += scalar
+    elif axis == "z":
+        points[:, 2] += scalar
+    return from_flat_data(points, lengths)
 
 
 def flip(streamlines, axis="x"):
-    new_sl = []
-    for sl in streamlines:
-        tmp = np.copy(sl)
-        if axis == "x":
-            tmp[:, 0] = tmp[:, 0] * -1
-        elif axis == "y":
-            tmp[:, 1] = tmp[:, 1] * -1
-        elif axis == "z":
-            tmp[:, 2] = tmp[:, 2] * -1
-        else:
-            raise ValueError("Unsupported axis")
-        new_sl.append(tmp)
-    return new_sl
+    axis_idx = {"x": 0, "y": 1, "z": 2}
+    if axis not in axis_idx:
+        raise ValueError("Unsupported axis")
+    points, offsets, lengths = get_flat_data(streamlines)
+    points = np.array(points)
+    points[:, axis_idx[axis]] *= -1
+    return from_flat_data(points, lengths)
 
 
 def transform_point(p, affine):
@@ -426,18 +826,24 @@ def invert_streamlines(streamlines, reference_img, affine, axis="x"):
 
     print(affine_invert)
 
-    return list(transform_streamlines(streamlines, affine_invert))
+    return transform_streamlines(as_streamlines(streamlines), affine_invert)
 
 
 def resample_to_same_distance(streamlines, max_nr_points=10, ANTI_INTERPOL_MULT=1):
-    dist = sl_length(streamlines).max() / max_nr_points
-    new_streamlines = []
-    for sl in streamlines:
-        l = sl_length(sl)
-        nr_segments = int(l / dist)
-        sl_new = set_number_of_points(sl, nb_points=nr_segments * ANTI_INTERPOL_MULT)
-        new_streamlines.append(sl_new)
-    return new_streamlines
+    streamlines = as_streamlines(streamlines)
+    sl_lengths = sl_length(streamlines)
+    dist = sl_lengths.max() / max_nr_points
+    nb_points = (sl_lengths / dist).astype(np.int64) * ANTI_INTERPOL_MULT
+
+    # set_number_of_points only supports the same nb_points for all streamlines -> one call for each group of
+    # streamlines with the same nb_points and write results to the right position in the flat point buffer
+    offsets = np.cumsum(nb_points) - nb_points
+    points = np.empty((nb_points.sum(), 3), dtype=get_flat_data(streamlines)[0].dtype)
+    for nb in np.unique(nb_points):
+        idxs = np.where(nb_points == nb)[0]
+        points_resampled = get_flat_data(set_number_of_points(streamlines[idxs], nb_points=int(nb)))[0]
+        points[(offsets[idxs][:, None] + np.arange(nb)).ravel()] = points_resampled
+    return from_flat_data(points, nb_points)
 
 
 def pad_sl_with_zeros(streamlines, target_len, pad_point):
@@ -449,11 +855,20 @@ def pad_sl_with_zeros(streamlines, target_len, pad_point):
 
 
 def get_idxs_of_closest_points(streamlines, target_point):
-    idxs = []
-    for sl in streamlines:
-        dists = []
-        for idx, p in enumerate(sl):
-            dist = abs(np.linalg.norm(p - target_point))
-            dists.append(dist)
-        idxs.append(np.array(dists).argmin())
-    return idxs
+    """
+    Get for each streamline the index of the point which is closest to target_point.
+
+    Args:
+        streamlines: list of streamlines or Streamlines object
+        target_point: [3]
+
+    Returns:
+        array of point indices [nr_streamlines]
+    """
+    points, offsets, lengths = get_flat_data(streamlines)
+    dists = np.linalg.norm(points - target_point, axis=1)
+    is_min = dists == np.repeat(np.minimum.reduceat(dists, offsets), lengths)
+    # First minimum of each streamline
+    min_pos = np.flatnonzero(is_min)
+    _, first = np.unique(np.repeat(np.arange(len(lengths)), lengths)[min_pos], return_index=True)
+    return min_pos[first] - offsets
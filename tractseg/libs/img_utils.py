@@ -407,17 +407,10 @@ def probs_to_binary_bundle_specific(seg, bundles):
     return np.array(segs_binary).transpose(1, 2, 3, 0).astype(np.uint8)
 
 
-def dilate_binary_mask(file_in, file_out, dilation=2):
-    img = nib.load(file_in)
-    data = img.get_data()
-
-    for i in range(dilation):
-        data = binary_dilation(data)
-
-    data = data > 0.5
-
-    img_out = nib.Nifti1Image(data.astype(np.uint8), img.affine)
-    nib.save(img_out, file_out)
+def dilate_binary_mask(data, dilation=2):
+    if dilation > 0:
+        data = binary_dilation(data, iterations=dilation)
+    return (data > 0.5).astype(np.uint8)
 
 
 def peaks2fixel(peaks_file_in, fixel_dir_out):
@@ -438,26 +431,20 @@ def peaks2fixel(peaks_file_in, fixel_dir_out):
     peaks = peaks_img.get_data()
     s = peaks.shape
 
-    directions = []
+    peak_len = np.linalg.norm(peaks, axis=-1)
+    mask = peak_len > 0  # fixels are numbered in C order of the voxels (same as np.nonzero)
+
     index = np.zeros(list(s[:3]) + [2])
-    amplitudes = []
-
-    idx_ctr = 0
-    for x in range(s[0]):
-        for y in range(s[1]):
-            for z in range(s[2]):
-                peak = peaks[x, y, z]
-                peak_len = np.linalg.norm(peak)
-                if peak_len > 0:
-                    peak_normalized = peak / (peak_len + 1e-20)
-                    directions.append(peak_normalized)
-                    amplitudes.append(peak_len)
-                    index[x, y, z] = [1, idx_ctr]
-                    idx_ctr += 1
-
-    nib.save(nib.Nifti2Image(np.array(directions), np.eye(4)), join(fixel_dir_out, "directions.nii.gz"))
-    nib.save(nib.Nifti2Image(index, peaks_img.affine), join(fixel_dir_out, "index.nii.gz"))
-    nib.save(nib.Nifti2Image(np.array(amplitudes), np.eye(4)), join(fixel_dir_out, "amplitudes.nii.gz"))
+    index[mask, 0] = 1
+    index[mask, 1] = np.arange(mask.sum())
+    amplitudes = peak_len[mask]
+    directions = peaks[mask] / (amplitudes[:, None] + 1e-20)
+
+    # gzip compression releases the GIL -> writing the images in threads runs concurrently
+    fixel_imgs = [(nib.Nifti2Image(directions, np.eye(4)), join(fixel_dir_out, "directions.nii.gz")),
+                  (nib.Nifti2Image(index, peaks_img.affine), join(fixel_dir_out, "index.nii.gz")),
+                  (nib.Nifti2Image(amplitudes, np.eye(4)), join(fixel_dir_out, "amplitudes.nii.gz"))]
+    Parallel(n_jobs=len(fixel_imgs), backend="threading")(delayed(nib.save)(img, path) for img, path in fixel_imgs)
 
 
 def flip_peaks(data, axis="x"):
@@ -5,7 +5,6 @@ from __future__ import print_function
 
 import numpy as np
 from sklearn.metrics import f1_score
-from sklearn.linear_model import LinearRegression
 
 from tractseg.data import dataset_specific_utils
 from tractseg.libs import peak_utils
@@ -316,41 +315,33 @@ def calc_peak_length_dice(classes, y_pred, y_true, max_angle_error=[0.9], max_le
 
 def calc_peak_length_dice_pytorch(classes, y_pred, y_true, max_angle_error=[0.9], max_length_error=0.1):
     import torch
-    from tractseg.libs import pytorch_utils
-
-    if len(y_pred.shape) == 4:  # 2D
-        y_true = y_true.permute(0, 2, 3, 1)
-        y_pred = y_pred.permute(0, 2, 3, 1)
-    else:  # 3D
-        y_true = y_true.permute(0, 2, 3, 4, 1)
-        y_pred = y_pred.permute(0, 2, 3, 4, 1)
-
 
-    #Single threshold
-    score_per_bundle = {}
     bundles = dataset_specific_utils.get_bundle_names(classes)[1:]
-    for idx, bundle in enumerate(bundles):
-        y_pred_bund = y_pred[..., (idx * 3):(idx * 3) + 3].contiguous()
-        y_true_bund = y_true[..., (idx * 3):(idx * 3) + 3].contiguous() # [x, y, z, 3]
 
-        angles = pytorch_utils.angle_last_dim(y_pred_bund, y_true_bund)
+    # [bs, bundles, x, y(, z)] for each of the 3 peak components: all bundles are evaluated at once instead of
+    # slicing and copying each bundle
+    shape = (y_pred.shape[0], len(bundles), 3) + tuple(y_pred.shape[2:])
+    pred_x, pred_y, pred_z = y_pred.reshape(shape).unbind(2)
+    true_x, true_y, true_z = y_true.reshape(shape).unbind(2)
 
-        lenghts_pred = torch.norm(y_pred_bund, 2., -1)
-        lengths_true = torch.norm(y_true_bund, 2, -1)
-        lengths_binary = torch.abs(lenghts_pred-lengths_true) < (max_length_error * lengths_true)
-        lengths_binary = lengths_binary.view(-1)
-
-        gt_binary = y_true_bund.sum(dim=-1) > 0
-        gt_binary = gt_binary.view(-1)  # [bs*x*y]
+    #Single threshold
+    lengths_pred = torch.sqrt(pred_x * pred_x + pred_y * pred_y + pred_z * pred_z)
+    lengths_true = torch.sqrt(true_x * true_x + true_y * true_y + true_z * true_z)
+    lengths_binary = torch.abs(lengths_pred - lengths_true) < (max_length_error * lengths_true)
 
-        angles_binary = angles > max_angle_error[0]
-        angles_binary = angles_binary.view(-1)
+    # Same as pytorch_utils.angle_last_dim, but reusing the lengths
+    angles = torch.abs((pred_x * true_x + pred_y * true_y + pred_z * true_z) / (lengths_pred * lengths_true + 1e-7))
+    angles_binary = angles > max_angle_error[0]
 
-        combined = lengths_binary * angles_binary
+    gt_binary = (true_x + true_y + true_z) > 0
+    combined = lengths_binary & angles_binary
 
-        f1 = pytorch_utils.f1_score_binary(gt_binary, combined)
-        score_per_bundle[bundle] = f1
-    return score_per_bundle
+    # f1 of each bundle (same as pytorch_utils.f1_score_binary)
+    axes = [0] + list(range(2, len(gt_binary.shape)))
+    intersect = torch.sum(gt_binary & combined, dim=axes)
+    denominator = torch.sum(gt_binary, dim=axes) + torch.sum(combined, dim=axes)
+    f1s = ((2 * intersect.float()) / (denominator.float() + 1e-6)).cpu().numpy()
+    return dict(zip(bundles, f1s))
 
 
 def unconfound(y, confound, group_data=False):
@@ -362,7 +353,8 @@ def unconfound(y, confound, group_data=False):
     calculating the residuals.
 
     Args:
-        y: [samples, targets]
+        y: [samples, targets] (all targets are corrected with one least squares fit, so stacking many targets
+           (e.g. all bundles and positions) is a lot faster than correcting each target separately)
         confound: [samples, confounds]
         group_data: if the data is made up of two groups (e.g. for t-test) or is just
                     one group (e.g. for correlation analysis)
@@ -373,10 +365,12 @@ def unconfound(y, confound, group_data=False):
     #y = demean(y)
     #confound = demean(confound)
 
-    lr = LinearRegression(fit_intercept=True).fit(confound, y)  # lr.coef_: [targets, confounds]
+    # One least squares fit (with intercept) for all targets at once
+    confound = np.asarray(confound, dtype=np.float64)
+    design = np.concatenate([np.ones((confound.shape[0], 1)), confound], axis=1)
+    coef = np.linalg.lstsq(design, y, rcond=None)[0][1:]  # [confounds, targets]
     if group_data:
-        y_predicted_by_confound = lr.coef_[:, 1:] @ confound[:, 1:].T
+        y_predicted_by_confound = confound[:, 1:] @ coef[1:]
     else:
-        y_predicted_by_confound = lr.coef_ @ confound.T  # [targets, samples]
-    y_corrected = y.T - y_predicted_by_confound
-    return y_corrected.T  # [samples, targets]
+        y_predicted_by_confound = confound @ coef  # [samples, targets]
+    return y - y_predicted_by_confound  # [samples, targets]
@@ -8,7 +8,6 @@ import math
 
 import numpy as np
 import nibabel as nib
-from nibabel import trackvis
 from dipy.tracking.streamline import transform_streamlines
 from scipy.ndimage.morphology import binary_dilation
 from dipy.tracking.streamline import set_number_of_points
@@ -381,27 +380,14 @@ def plot_bundles_with_metric(bundle_path, endings_path, brain_mask_path, bundle,
         beginnings = binary_dilation(beginnings)
 
     # Load trackings
-    if tracking_format == "trk_legacy":
-        streams, hdr = trackvis.read(bundle_path)
-        streamlines = [s[0] for s in streams]
-    else:
-        sl_file = nib.streamlines.load(bundle_path)
-        streamlines = sl_file.streamlines
-    streamlines = list(transform_streamlines(streamlines, np.linalg.inv(beginnings_img.affine)))
+    streamlines = fiber_utils.load_streamlines(bundle_path, tracking_format=tracking_format)
+    streamlines = transform_streamlines(streamlines, np.linalg.inv(beginnings_img.affine))
 
     # Reduce streamline count
     streamlines = streamlines[::2]
 
     # Reorder to make all streamlines have same start region
-    streamlines = fiber_utils.add_to_each_streamline(streamlines, 0.5)
-    streamlines_new = []
-    for idx, sl in enumerate(streamlines):
-        startpoint = sl[0]
-        # Flip streamline if not in right order
-        if beginnings[int(startpoint[0]), int(startpoint[1]), int(startpoint[2])] == 0:
-            sl = sl[::-1, :]
-        streamlines_new.append(sl)
-    streamlines = fiber_utils.add_to_each_streamline(streamlines_new, -0.5)
+    streamlines = fiber_utils.orient_to_same_start_region(streamlines, beginnings)
 
     if algorithm == "distance_map" or algorithm == "equal_dist":
         streamlines = fiber_utils.resample_fibers(streamlines, NR_SEGMENTS * ANTI_INTERPOL_MULT)
@@ -426,7 +412,9 @@ def plot_bundles_with_metric(bundle_path, endings_path, brain_mask_path, bundle,
         qb = QuickBundles(threshold=100., metric=metric)
         clusters = qb.cluster(streamlines)
         centroids = Streamlines(clusters.centroids)
-        _, segment_idxs = cKDTree(centroids.data, 1, copy_data=True).query(streamlines, k=1)
+        points = fiber_utils.get_flat_data(streamlines)[0].reshape(-1, NR_SEGMENTS * ANTI_INTERPOL_MULT, 3)
+        centroid_points = fiber_utils.get_flat_data(centroids)[0]
+        _, segment_idxs = cKDTree(centroid_points, 1, copy_data=True).query(points, k=1)
 
     elif algorithm == "cutting_plane":
         streamlines_resamp = fiber_utils.resample_fibers(streamlines, NR_SEGMENTS * ANTI_INTERPOL_MULT)
@@ -450,7 +438,7 @@ def plot_bundles_with_metric(bundle_path, endings_path, brain_mask_path, bundle,
         segment_idxs = segment_idxs_eqlen
 
     # Add extra point otherwise coloring BUG
-    streamlines = _add_extra_point_to_last_streamline(streamlines)
+    streamlines = _add_extra_point_to_last_streamline(list(streamlines))
 
     renderer = window.Renderer()
     colors_all = []  # final shape will be [nr_streamlines, nr_points, 3]
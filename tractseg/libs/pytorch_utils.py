@@ -65,29 +65,15 @@ def f1_score_macro(y_true, y_pred, per_class=False, threshold=0.5):
     y_true = y_true.byte()
     y_pred = (y_pred > threshold).byte()
 
-    if len(y_true.size()) == 4:  # 2D
-        y_true = y_true.permute(0, 2, 3, 1)
-        y_pred = y_pred.permute(0, 2, 3, 1)
-
-        y_true = y_true.contiguous().view(-1, y_true.size()[3])  # [bs*x*y, classes]
-        y_pred = y_pred.contiguous().view(-1, y_pred.size()[3])
-    else:  # 3D
-        y_true = y_true.permute(0, 2, 3, 4, 1)
-        y_pred = y_pred.permute(0, 2, 3, 4, 1)
-
-        y_true = y_true.contiguous().view(-1, y_true.size()[4])  # [bs*x*y, classes]
-        y_pred = y_pred.contiguous().view(-1, y_pred.size()[4])
-
-    f1s = []
-    for i in range(y_true.size()[1]):
-        intersect = torch.sum(y_true[:, i] * y_pred[:, i])  # works because all multiplied by 0 gets 0
-        denominator = torch.sum(y_true[:, i]) + torch.sum(y_pred[:, i])  # works because all multiplied by 0 gets 0
-        f1 = (2 * intersect.float()) / (denominator.float() + 1e-6)
-        f1s.append(f1.to('cpu'))
+    # Sum over all dimensions except classes -> all classes in one reduction and one transfer to the cpu
+    axes = [0] + list(range(2, len(y_true.size())))
+    intersect = torch.sum(y_true * y_pred, dim=axes)  # works because all multiplied by 0 gets 0
+    denominator = torch.sum(y_true, dim=axes) + torch.sum(y_pred, dim=axes)
+    f1s = ((2 * intersect.float()) / (denominator.float() + 1e-6)).cpu().numpy()
     if per_class:
-        return np.array(f1s)
+        return f1s
     else:
-        return np.mean(np.array(f1s))
+        return np.mean(f1s)
 
 
 def f1_score_binary(y_true, y_pred):
@@ -18,7 +18,7 @@ from tractseg.libs import peak_utils
 def _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus):
     ref_img = nib.load(output_dir + "/bundle_segmentations" + dir_postfix + "/" + bundle + ".nii.gz")
     reference_affine = ref_img.affine
-    reference_shape = ref_img.get_data().shape[:3]
+    reference_shape = ref_img.shape[:3]
     fiber_utils.convert_tck_to_trk(output_dir + "/" + tracking_folder + "/" + bundle + ".tck",
                                    output_dir + "/" + tracking_folder + "/" + bundle + ".trk",
                                    reference_affine, reference_shape, compress_err_thr=0.1, smooth=None,
@@ -44,7 +44,7 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
           use_best_original_peaks=False, use_as_prior=False, filter_by_endpoints=True,
           tracking_folder="auto", dir_postfix="", dilation=1,
           next_step_displacement_std=0.15,
-          output_format="trk", nr_fibers=2000, nr_cpus=-1):
+          output_format="trk", nr_fibers=2000, nr_cpus=-1, seed=None):
 
     ################### Preparing ###################
 
@@ -62,14 +62,26 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
     # Misc
     subprocess.call("export PATH=/code/mrtrix3/bin:$PATH", shell=True)
     subprocess.call("mkdir -p " + output_dir + "/" + tracking_folder, shell=True)
-    tmp_dir = tempfile.mkdtemp()
+    # Only needed for MRtrix. TractSeg tracking runs entirely in memory.
+    if tracking_software == "mrtrix" or not filter_by_endpoints:
+        tmp_dir = tempfile.mkdtemp()
+    else:
+        tmp_dir = None
 
     # Check if bundle masks are valid
+    bundle_mask_ok = beginnings_mask_ok = endings_mask_ok = True
     if filter_by_endpoints:
-        bundle_mask_ok = nib.load(output_dir + "/bundle_segmentations" + dir_postfix
-                                  + "/" + bundle + ".nii.gz").get_data().max() > 0
-        beginnings_mask_ok = nib.load(output_dir + "/endings_segmentations/" + bundle + "_b.nii.gz").get_data().max() > 0
-        endings_mask_ok = nib.load(output_dir + "/endings_segmentations/" + bundle + "_e.nii.gz").get_data().max() > 0
+        # Load each mask only once and reuse it for all further steps
+        bundle_mask_img = nib.load(output_dir + "/bundle_segmentations" + dir_postfix + "/" + bundle + ".nii.gz")
+        beginnings_img = nib.load(output_dir + "/endings_segmentations/" + bundle + "_b.nii.gz")
+        endings_img = nib.load(output_dir + "/endings_segmentations/" + bundle + "_e.nii.gz")
+        bundle_mask_data = bundle_mask_img.get_data()
+        beginnings_data = beginnings_img.get_data()
+        endings_data = endings_img.get_data()
+
+        bundle_mask_ok = bundle_mask_data.max() > 0
+        beginnings_mask_ok = beginnings_data.max() > 0
+        endings_mask_ok = endings_data.max() > 0
 
         if not bundle_mask_ok:
             print("WARNING: tract mask of {} empty. Creating empty tractogram.".format(bundle))
@@ -96,13 +108,16 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
             # Mrtrix Tracking
             if tracking_software == "mrtrix":
 
-                # Prepare files
-                img_utils.dilate_binary_mask(output_dir + "/bundle_segmentations" + dir_postfix + "/" + bundle + ".nii.gz",
-                                             tmp_dir + "/" + bundle + ".nii.gz", dilation=dilation)
-                img_utils.dilate_binary_mask(output_dir + "/endings_segmentations/" + bundle + "_e.nii.gz",
-                                             tmp_dir + "/" + bundle + "_e.nii.gz", dilation=dilation + 1)
-                img_utils.dilate_binary_mask(output_dir + "/endings_segmentations/" + bundle + "_b.nii.gz",
-                                             tmp_dir + "/" + bundle + "_b.nii.gz", dilation=dilation + 1)
+                # Prepare files (masks already loaded, only have to be dilated and written for tckgen)
+                nib.save(nib.Nifti1Image(img_utils.dilate_binary_mask(bundle_mask_data, dilation=dilation),
+                                         bundle_mask_img.affine),
+                         tmp_dir + "/" + bundle + ".nii.gz")
+                nib.save(nib.Nifti1Image(img_utils.dilate_binary_mask(endings_data, dilation=dilation + 1),
+                                         endings_img.affine),
+                         tmp_dir + "/" + bundle + "_e.nii.gz")
+                nib.save(nib.Nifti1Image(img_utils.dilate_binary_mask(beginnings_data, dilation=dilation + 1),
+                                         beginnings_img.affine),
+                         tmp_dir + "/" + bundle + "_b.nii.gz")
 
                 # Mrtrix tracking on original FODs (have to be provided to -i)
                 if tracking_on_FODs:
@@ -171,18 +186,14 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
             else:
 
                 # Prepare files
-                bundle_mask_img = nib.load(output_dir + "/bundle_segmentations" + dir_postfix + "/"
-                                           + bundle + ".nii.gz")
-                beginnings_img = nib.load(output_dir + "/endings_segmentations/" + bundle + "_b.nii.gz")
-                endings_img = nib.load(output_dir + "/endings_segmentations/" + bundle + "_e.nii.gz")
                 tom_peaks_img = nib.load(output_dir + "/" + TOM_folder + "/" + bundle + ".nii.gz")
 
                 # Ensure same orientation as MNI space
-                bundle_mask, flip_axis = img_utils.flip_axis_to_match_MNI_space(bundle_mask_img.get_data(),
+                bundle_mask, flip_axis = img_utils.flip_axis_to_match_MNI_space(bundle_mask_data,
                                                                                 bundle_mask_img.affine)
-                beginnings, flip_axis = img_utils.flip_axis_to_match_MNI_space(beginnings_img.get_data(),
+                beginnings, flip_axis = img_utils.flip_axis_to_match_MNI_space(beginnings_data,
                                                                                 beginnings_img.affine)
-                endings, flip_axis = img_utils.flip_axis_to_match_MNI_space(endings_img.get_data(),
+                endings, flip_axis = img_utils.flip_axis_to_match_MNI_space(endings_data,
                                                                                 endings_img.affine)
                 tom_peaks, flip_axis = img_utils.flip_axis_to_match_MNI_space(tom_peaks_img.get_data(),
                                                                                   tom_peaks_img.affine)
@@ -216,6 +227,7 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                     tom_peaks = weighted_peaks
 
                 # Takes around 6min for 1 subject (2mm resolution)
+                # Returns Streamlines object which is directly passed to the writer (no intermediate files)
                 streamlines = tractseg_prob_tracking.track(tom_peaks, max_nr_fibers=nr_fibers, smooth=5,
                                                            compress=0.1, bundle_mask=bundle_mask, start_mask=beginnings,
                                                            end_mask=endings,
@@ -224,17 +236,17 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                                                            next_step_displacement_std=next_step_displacement_std,
                                                            nr_cpus=nr_cpus, affine=bundle_mask_img.affine,
                                                            spacing=bundle_mask_img.header.get_zooms()[0],
-                                                           verbose=False)
+                                                           seed=seed, verbose=False)
 
                 if output_format == "trk_legacy":
                     fiber_utils.save_streamlines_as_trk_legacy(output_dir + "/" + tracking_folder + "/" + bundle + ".trk",
                                                                streamlines, bundle_mask_img.affine,
-                                                               bundle_mask_img.get_data().shape)
+                                                               bundle_mask_data.shape)
                 else:  # tck or trk (determined by file ending)
                     fiber_utils.save_streamlines(
                         output_dir + "/" + tracking_folder + "/" + bundle + "." + output_format,
                         streamlines, bundle_mask_img.affine,
-                        bundle_mask_img.get_data().shape)
+                        bundle_mask_data.shape)
 
 
         # No streamline filtering
@@ -255,4 +267,5 @@ def track(bundle, peaks, output_dir, tracking_on_FODs, tracking_software, tracki
                 _mrtrix_tck_to_trk(output_dir, tracking_folder, dir_postfix, bundle, output_format, nr_cpus)
 
 
-    shutil.rmtree(tmp_dir)
+    if tmp_dir is not None:
+        shutil.rmtree(tmp_dir)
@@ -3,9 +3,19 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from collections import defaultdict
-
+import os
+import json
+import hashlib
+import multiprocessing
+from os.path import join
+from os.path import exists
+from os.path import basename
+
+import psutil
 import numpy as np
+import nibabel as nib
+from joblib import Parallel, delayed
+from tqdm import tqdm
 from scipy.ndimage.morphology import binary_dilation
 from scipy.ndimage.interpolation import map_coordinates
 from dipy.segment.clustering import QuickBundles
@@ -32,22 +42,78 @@ def _get_length_best_orig_peak(predicted_img, orig_img, x, y, z):
     return best_peak_len
 
 
-def _orient_to_same_start_region(streamlines, beginnings):
-    # (we could also use dipy.tracking.streamline.orient_by_streamline instead)
-    streamlines = fiber_utils.add_to_each_streamline(streamlines, 0.5)
-    streamlines_new = []
-    for idx, sl in enumerate(streamlines):
-        startpoint = sl[0]
-        # Flip streamline if not in right order
-        if beginnings[int(startpoint[0]), int(startpoint[1]), int(startpoint[2])] == 0:
-            sl = sl[::-1, :]
-        streamlines_new.append(sl)
-    streamlines_new = fiber_utils.add_to_each_streamline(streamlines_new, -0.5)
-    return streamlines_new
+def _aggregate_by_segment(values, segment_idxs, nr_segments):
+    """
+    Mean and std of all values belonging to the same segment (np.bincount instead of grouping in python lists).
+
+    Args:
+        values: values of all points [nr_points_total, nr_metrics]
+        segment_idxs: segment index of each point [nr_points_total]
+        nr_segments: number of segments
+
+    Returns:
+        (mean [nr_segments, nr_metrics], std [nr_segments, nr_metrics]); NaN for segments without any points
+    """
+    counts = np.bincount(segment_idxs, minlength=nr_segments)
+    mean = np.zeros((nr_segments, values.shape[1]))
+    std = np.zeros((nr_segments, values.shape[1]))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for idx in range(values.shape[1]):
+            mean[:, idx] = np.bincount(segment_idxs, weights=values[:, idx], minlength=nr_segments) / counts
+            # Sum of squared deviations from the mean (two pass for numerical stability)
+            sq_dev = np.bincount(segment_idxs, weights=(values[:, idx] - mean[segment_idxs, idx]) ** 2,
+                                 minlength=nr_segments)
+            std[:, idx] = np.sqrt(sq_dev / counts)
+    return mean, std
+
+
+def _sample_scalar_imgs(scalar_imgs, points):
+    """
+    Sample all scalar images at the given points (one map_coordinates call per scalar image).
+
+    Args:
+        scalar_imgs: [x, y, z, nr_metrics]
+        points: [nr_points, 3] in voxel space
+
+    Returns:
+        values [nr_points, nr_metrics]
+    """
+    points = np.asarray(points).T
+    return np.stack([map_coordinates(scalar_imgs[..., idx], points, order=1) for idx in range(scalar_imgs.shape[3])],
+                    axis=-1)
+
+
+def _fill_empty_segments(results_mean, results_std, scalar_imgs, centroid):
+    empty_segments = np.isnan(results_mean[:, 0])
+    if empty_segments.any():
+        print("WARNING: found less than required points. Filling up with centroid values.")
+        centroid_values = _sample_scalar_imgs(scalar_imgs, centroid[:len(results_mean)])
+        results_mean[empty_segments] = centroid_values[empty_segments]
+        results_std[empty_segments] = 0
+    return results_mean, results_std
 
 
 def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, dilate=0, predicted_peaks=None,
                                affine=None):
+    """
+    Evaluate scalar image along streamlines.
+
+    Args:
+        scalar_img: scalar image [x, y, z] or several scalar images stacked along the last axis
+            [x, y, z, nr_metrics] (if predicted_peaks is not None: original peaks [x, y, z, 9]). For several scalar
+            images the streamline geometry (orientation, resampling, clustering, segment assignment) is only
+            computed once.
+        streamlines: streamlines in RASmm
+        beginnings: beginnings mask of the bundle
+        nr_points: number of points along the bundle
+        dilate: number of dilations of the beginnings mask
+        predicted_peaks: TOM of the bundle. If set, the length of the original peak best matching the TOM is
+            evaluated.
+        affine: affine of scalar_img
+
+    Returns:
+        (mean, std) each [nr_points] (or [nr_points, nr_metrics] if scalar_img is a stack of scalar images)
+    """
     # Runtime:
     # - default:                2.7s (test),    56s (all),      10s (test 4 bundles, 100 points)
     # - map_coordinate order 1: 1.9s (test),    26s (all),       6s (test 4 bundles, 100 points)
@@ -56,35 +122,39 @@ def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, d
     # - AFQ:                      ?s (test),     ?s (all),      85s  (test 4 bundles, 100 points)
     # => AFQ a lot slower than others
 
-    streamlines = list(transform_streamlines(streamlines, np.linalg.inv(affine)))
+    streamlines = transform_streamlines(fiber_utils.as_streamlines(streamlines), np.linalg.inv(affine))
 
     for i in range(dilate):
         beginnings = binary_dilation(beginnings)
     beginnings = beginnings.astype(np.uint8)
-    streamlines = _orient_to_same_start_region(streamlines, beginnings)
+    streamlines = fiber_utils.orient_to_same_start_region(streamlines, beginnings)
     if predicted_peaks is not None:
         # scalar img can also be orig peaks
         best_orig_peaks = fiber_utils.get_best_original_peaks(predicted_peaks, scalar_img, peak_len_thr=0.00001)
         scalar_img = np.linalg.norm(best_orig_peaks, axis=-1)
 
+    single_metric = scalar_img.ndim == 3
+    scalar_imgs = scalar_img[..., None] if single_metric else scalar_img
+
     algorithm = "distance_map"  # equal_dist | distance_map | cutting_plane | afq
 
 
     if algorithm == "equal_dist":
         ### Sampling ###
         streamlines = fiber_utils.resample_fibers(streamlines, nb_points=nr_points)
-        values = map_coordinates(scalar_img, np.array(streamlines).T, order=1)
+        points = fiber_utils.get_flat_data(streamlines)[0]
+        values = _sample_scalar_imgs(scalar_imgs, points).reshape(-1, nr_points, scalar_imgs.shape[3])
         ### Aggregation ###
-        values_mean = np.array(values).mean(axis=1)
-        values_std = np.array(values).std(axis=1)
-        return values_mean, values_std
+        results_mean = values.mean(axis=0)
+        results_std = values.std(axis=0)
 
 
-    if algorithm == "distance_map":  # cKDTree
+    elif algorithm == "distance_map":  # cKDTree
 
         ### Sampling ###
         streamlines = fiber_utils.resample_fibers(streamlines, nb_points=nr_points)
-        values = map_coordinates(scalar_img, np.array(streamlines).T, order=1)
+        points = fiber_utils.get_flat_data(streamlines)[0]  # (2000 * 100, 3)
+        values = _sample_scalar_imgs(scalar_imgs, points)  # (2000 * 100, nr_metrics)
 
         ### Aggregating by cKDTree approach ###
         metric = AveragePointwiseEuclideanMetric()
@@ -93,39 +163,18 @@ def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, d
         centroids = Streamlines(clusters.centroids)
         if len(centroids) > 1:
             print("WARNING: number clusters > 1 ({})".format(len(centroids)))
-        _, segment_idxs = cKDTree(centroids.data, 1, copy_data=True).query(streamlines, k=1)  # (2000, 100)
-
-        values_t = np.array(values).T  # (2000, 100)
+        centroid_points = fiber_utils.get_flat_data(centroids)[0]
+        _, segment_idxs = cKDTree(centroid_points, 1, copy_data=True).query(points, k=1)  # (2000 * 100)
+        # If there are several centroids: point i of each centroid belongs to segment i
+        segment_idxs = segment_idxs % nr_points
 
         # If we want to take weighted mean like in AFQ:
         # weights = dsa.gaussian_weights(Streamlines(streamlines))
         # values_t = weights * values_t
         # return np.sum(values_t, 0), None
 
-        results_dict = defaultdict(list)
-        for idx, sl in enumerate(values_t):
-            for jdx, seg in enumerate(sl):
-                results_dict[segment_idxs[idx, jdx]].append(seg)
-
-        if len(results_dict.keys()) < nr_points:
-            print("WARNING: found less than required points. Filling up with centroid values.")
-            centroid_values = map_coordinates(scalar_img, np.array([centroids[0]]).T, order=1)
-            for i in range(nr_points):
-                if len(results_dict[i]) == 0:
-                    results_dict[i].append(np.array(centroid_values).T[0, i])
-
-        results_mean = []
-        results_std = []
-        for key in sorted(results_dict.keys()):
-            value = results_dict[key]
-            if len(value) > 0:
-                results_mean.append(np.array(value).mean())
-                results_std.append(np.array(value).std())
-            else:
-                print("WARNING: empty segment")
-                results_mean.append(0)
-                results_std.append(0)
-        return results_mean, results_std
+        results_mean, results_std = _aggregate_by_segment(values, segment_idxs, nr_points)
+        results_mean, results_std = _fill_empty_segments(results_mean, results_std, scalar_imgs, centroids[0])
 
 
     elif algorithm == "cutting_plane":
@@ -138,7 +187,7 @@ def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, d
         ### Sampling ###
         streamlines = fiber_utils.resample_to_same_distance(streamlines, max_nr_points=nr_points)
         # map_coordinates does not allow streamlines with different lengths -> use values_from_volume
-        values = np.array(values_from_volume(scalar_img, streamlines, affine=np.eye(4))).T
+        values = np.concatenate(values_from_volume(scalar_imgs, streamlines, affine=np.eye(4)))
 
         ### Aggregating by Cutting Plane approach ###
         # Resample to all fibers having same number of points -> needed for QuickBundles
@@ -152,64 +201,264 @@ def evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, d
         middle_idx = int(nr_points / 2)
         middle_point = centroids[0][middle_idx]
         # For each streamline get idx for the point which is closest to the middle
-        segment_idxs = fiber_utils.get_idxs_of_closest_points(streamlines, middle_point)
-
-        # Align along the middle and assign indices
-        segment_idxs_eqlen = []
-        base_idx = 1000  # use higher index to avoid negative numbers for area below middle
-        for idx, sl in enumerate(streamlines):
-            sl_middle_pos = segment_idxs[idx]
-            before_elems = sl_middle_pos
-            after_elems = len(sl) - sl_middle_pos
-            # indices for one streamline e.g. [998, 999, 1000, 1001, 1002, 1003]; 1000 is middle
-            r = range((base_idx - before_elems), (base_idx + after_elems))
-            segment_idxs_eqlen.append(r)
-        segment_idxs = segment_idxs_eqlen
-
-        # Calcuate maximum number of indices to not result in more indices than nr_points.
-        # (this could be case if one streamline is very off-center and therefore has a lot of points only on one
-        # side. In this case the values too far out of this streamline will be cut off).
-        max_idx = base_idx + int(nr_points / 2)
-        min_idx = base_idx - int(nr_points / 2)
-
-        # Group by segment indices
-        results_dict = defaultdict(list)
-        for idx, sl in enumerate(values):
-            for jdx, seg in enumerate(sl):
-                current_idx = segment_idxs[idx][jdx]
-                if current_idx >= min_idx and current_idx < max_idx:
-                    results_dict[current_idx].append(seg)
+        middle_pos = fiber_utils.get_idxs_of_closest_points(streamlines, middle_point)
+
+        # Align along the middle and assign indices: indices of one streamline e.g. [-2, -1, 0, 1, 2, 3]; 0 is middle
+        _, offsets, lengths = fiber_utils.get_flat_data(streamlines)
+        segment_idxs = np.arange(lengths.sum()) - np.repeat(offsets + middle_pos, lengths)
+
+        # Only keep nr_points/2 indices on each side of the middle. (If one streamline is very off-center and
+        # therefore has a lot of points only on one side the values too far out of this streamline will be cut off).
+        half = int(nr_points / 2)
+        inside = (segment_idxs >= -half) & (segment_idxs < half)
+        results_mean, results_std = _aggregate_by_segment(values[inside], segment_idxs[inside] + half, 2 * half)
 
         # If values missing fill up with centroid values
-        if len(results_dict.keys()) < nr_points:
-            print("WARNING: found less than required points. Filling up with centroid values.")
-            centroid_sl = [centroids[0]]
-            centroid_sl = np.array(centroid_sl).T
-            centroid_values = map_coordinates(scalar_img, centroid_sl, order=1)
-            for idx, seg_idx in enumerate(range(min_idx, max_idx)):
-                if len(results_dict[seg_idx]) == 0:
-                    results_dict[seg_idx].append(np.array(centroid_values).T[0, idx])
-
-        # Aggregate by mean
-        results_mean = []
-        results_std = []
-        for key in sorted(results_dict.keys()):
-            value = results_dict[key]
-            if len(value) > 0:
-                results_mean.append(np.array(value).mean())
-                results_std.append(np.array(value).std())
-            else:
-                print("WARNING: empty segment")
-                results_mean.append(0)
-                results_std.append(0)
-        return results_mean, results_std
+        results_mean, results_std = _fill_empty_segments(results_mean, results_std, scalar_imgs, centroids[0])
 
 
     elif algorithm == "afq":
         ### sampling + aggregation ###
         streamlines = fiber_utils.resample_fibers(streamlines, nb_points=nr_points)
-        streamlines = Streamlines(streamlines)
         weights = dsa.gaussian_weights(streamlines)
-        results_mean = dsa.afq_profile(scalar_img, streamlines, affine=np.eye(4), weights=weights)
-        results_std = np.zeros(nr_points)
-        return results_mean, results_std
+        results_mean = np.stack([dsa.afq_profile(scalar_imgs[..., idx], streamlines, affine=np.eye(4),
+                                                 weights=weights)
+                                 for idx in range(scalar_imgs.shape[3])], axis=-1)
+        results_std = np.zeros(results_mean.shape)
+
+    if single_metric:
+        return results_mean[:, 0], results_std[:, 0]
+    return results_mean, results_std
+
+
+def _evaluate_bundle(bundle, scalar_img, affine, tracking_dir, endings_dir, nr_points, dilation=0,
+                     tracking_format="trk_legacy", TOM_dir=None, min_nr_streamlines=5):
+    file_ending = "trk" if tracking_format == "trk_legacy" else tracking_format
+    trk_path = join(tracking_dir, bundle + "." + file_ending)
+    # Peak length gives one value per point, otherwise one value per scalar image
+    result_shape = (nr_points,) if TOM_dir is not None or scalar_img.ndim == 3 else (nr_points, scalar_img.shape[3])
+
+    if not exists(trk_path):
+        print("WARNING: No tracking found for bundle {}. Returning zeros.".format(bundle))
+        return np.zeros(result_shape), np.zeros(result_shape)
+
+    streamlines = fiber_utils.load_streamlines(trk_path, tracking_format=tracking_format)
+    if len(streamlines) < min_nr_streamlines:
+        print("WARNING: bundle {} contains less than {} streamlines. Saving value 0 for this bundle.".
+              format(bundle, min_nr_streamlines))
+        return np.zeros(result_shape), np.zeros(result_shape)
+
+    predicted_peaks = nib.load(join(TOM_dir, bundle + ".nii.gz")).get_data() if TOM_dir is not None else None
+    beginnings = nib.load(join(endings_dir, bundle + "_b.nii.gz")).get_data()
+    mean, std = evaluate_along_streamlines(scalar_img, streamlines, beginnings, nr_points, dilate=dilation,
+                                           predicted_peaks=predicted_peaks, affine=affine)
+    return np.array(mean), np.array(std)
+
+
+def evaluate_subject(scalar_img, affine, tracking_dir, endings_dir, bundles, nr_points, dilation=0,
+                     tracking_format="trk_legacy", TOM_dir=None, min_nr_streamlines=5, nr_cpus=-1):
+    """
+    Run tractometry for all bundles of one subject. The scalar image is only loaded once and the bundles are
+    evaluated in parallel (joblib shares the scalar image with the worker processes via memmapping).
+
+    Args:
+        scalar_img: scalar image (e.g. FA), several scalar images stacked along the last axis [x, y, z, nr_metrics]
+            or peak image if using TOM_dir (peak length)
+        affine: affine of scalar_img
+        tracking_dir: folder containing the tractograms of all bundles
+        endings_dir: folder containing the endings segmentations of all bundles
+        bundles: list of bundle names
+        nr_points: number of points along each bundle
+        dilation: dilation of the beginnings mask
+        tracking_format: trk_legacy | trk | tck
+        TOM_dir: folder containing the TOMs. If set, the length of the peak best matching the TOM is evaluated
+            instead of the scalar image.
+        min_nr_streamlines: bundles with less streamlines get value 0
+        nr_cpus: number of processes. -1 means all available CPUs
+
+    Returns:
+        (mean, std) each [nr_bundles, nr_points] (or [nr_bundles, nr_points, nr_metrics] for stacked scalar images)
+    """
+    scalar_img = np.nan_to_num(scalar_img)
+    nr_cpus = psutil.cpu_count() if nr_cpus == -1 else nr_cpus
+    results = Parallel(n_jobs=max(1, min(nr_cpus, len(bundles))))(
+        delayed(_evaluate_bundle)(bundle, scalar_img, affine, tracking_dir, endings_dir, nr_points,
+                                  dilation=dilation, tracking_format=tracking_format, TOM_dir=TOM_dir,
+                                  min_nr_streamlines=min_nr_streamlines)
+        for bundle in bundles)
+    results_mean = np.array([mean for mean, std in results])
+    results_std = np.array([std for mean, std in results])
+    return results_mean, results_std
+
+
+def get_metric_names(scalar_img_paths, nr_volumes):
+    """
+    Name of each scalar volume: file name of the scalar image (e.g. "FA"), with volume index appended for 4D images.
+
+    Args:
+        scalar_img_paths: list of paths of the scalar images
+        nr_volumes: number of volumes of each scalar image
+
+    Returns:
+        list of metric names
+    """
+    names = []
+    for path, nr in zip(scalar_img_paths, nr_volumes):
+        name = basename(path).split(".")[0]
+        names += [name] if nr == 1 else ["{}_{}".format(name, idx) for idx in range(nr)]
+    return names
+
+
+def _get_input_fingerprint(paths):
+    """
+    Hash of path, size and modification time of all input files (missing files are part of the hash as well).
+    """
+    md5 = hashlib.md5()
+    for path in paths:
+        if exists(path):
+            stat = os.stat(path)
+            md5.update("{};{};{}\n".format(path, stat.st_size, stat.st_mtime).encode("utf-8"))
+        else:
+            md5.update("{};missing\n".format(path).encode("utf-8"))
+    return md5.hexdigest()
+
+
+def _get_subject_paths(subject, tracking_dir, endings_dir, scalar_img_paths, bundles, tracking_format):
+    file_ending = "trk" if tracking_format == "trk_legacy" else tracking_format
+    tracking_dir = tracking_dir.replace("SUBJECT_ID", subject)
+    endings_dir = endings_dir.replace("SUBJECT_ID", subject)
+    scalar_img_paths = [path.replace("SUBJECT_ID", subject) for path in scalar_img_paths]
+    input_paths = scalar_img_paths + \
+                  [join(tracking_dir, bundle + "." + file_ending) for bundle in bundles] + \
+                  [join(endings_dir, bundle + "_b.nii.gz") for bundle in bundles]
+    return tracking_dir, endings_dir, scalar_img_paths, input_paths
+
+
+def _evaluate_cohort_subject(subject, tracking_dir, endings_dir, scalar_img_paths, bundles, nr_points, dilation,
+                             tracking_format, min_nr_streamlines):
+    tracking_dir, endings_dir, scalar_img_paths, input_paths = \
+        _get_subject_paths(subject, tracking_dir, endings_dir, scalar_img_paths, bundles, tracking_format)
+    # Get fingerprint before processing, so that files changed during processing will be processed again next time
+    fingerprint = _get_input_fingerprint(input_paths)
+    scalar_images = [nib.load(path) for path in scalar_img_paths]
+    scalar_data = np.concatenate([img.get_data().reshape(img.shape[:3] + (-1,)) for img in scalar_images], axis=3)
+    # Subjects are processed in parallel -> bundles sequentially
+    results, _ = evaluate_subject(scalar_data, scalar_images[0].affine, tracking_dir, endings_dir, bundles, nr_points,
+                                  dilation=dilation, tracking_format=tracking_format,
+                                  min_nr_streamlines=min_nr_streamlines, nr_cpus=1)
+    # Remove first and last segment as those tend to be more noisy (same as in Tractometry CSV files)
+    results = results.reshape(len(bundles), nr_points, -1)[:, 1:-1]
+    return subject, fingerprint, results.astype(np.float32)
+
+
+def _evaluate_cohort_subject_star(args):
+    return _evaluate_cohort_subject(*args)
+
+
+def _save_cohort_meta(cohort_file, meta):
+    # Write to temporary file and rename, so that the meta data is never left half written if the run is aborted
+    meta_file = cohort_file + ".json"
+    with open(meta_file + ".tmp", "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(meta_file + ".tmp", meta_file)
+
+
+def load_cohort(cohort_file, mmap_mode="r"):
+    """
+    Load tractometry results of a cohort created with run_cohort.
+
+    Args:
+        cohort_file: path of the cohort file (.npy)
+        mmap_mode: memory map the results (see np.load)
+
+    Returns:
+        (results [nr_subjects, nr_bundles, nr_points, nr_metrics], meta data dict with keys "subjects", "bundles",
+        "metrics", "nr_points", "fingerprints")
+    """
+    with open(cohort_file + ".json") as f:
+        meta = json.load(f)
+    return np.load(cohort_file, mmap_mode=mmap_mode), meta
+
+
+def run_cohort(cohort_file, subjects, tracking_dir, endings_dir, scalar_img_paths, bundles, nr_points=100,
+               dilation=2, tracking_format="trk_legacy", min_nr_streamlines=5, nr_cpus=-1):
+    """
+    Run tractometry for all subjects of a cohort. All results are stored in one array
+    [nr_subjects, nr_bundles, nr_points-2, nr_metrics] (first and last point removed like in the Tractometry CSV
+    files) saved as .npy (can be memory mapped) plus a .json file with the meta data. The results of each subject
+    are written as soon as the subject is finished. Subjects whose input files did not change since the last run
+    are not processed again, so an aborted run can simply be restarted.
+
+    Args:
+        cohort_file: path of the output file (.npy). Meta data is saved to cohort_file + ".json"
+        subjects: list of subject IDs
+        tracking_dir: folder containing the tractograms. "SUBJECT_ID" will be replaced by the subject ID.
+        endings_dir: folder containing the endings segmentations. "SUBJECT_ID" will be replaced by the subject ID.
+        scalar_img_paths: list of paths of the scalar images. "SUBJECT_ID" will be replaced by the subject ID.
+        bundles: list of bundle names
+        nr_points: number of points along each bundle
+        dilation: dilation of the beginnings mask
+        tracking_format: trk_legacy | trk | tck
+        min_nr_streamlines: bundles with less streamlines get value 0
+        nr_cpus: number of processes (one subject per process). -1 means all available CPUs
+
+    Returns:
+        (results, meta data) like load_cohort
+    """
+    # Number of volumes of each scalar image (taken from first subject)
+    nr_volumes = [int(np.prod(nib.load(path.replace("SUBJECT_ID", subjects[0])).shape[3:], dtype=np.int64))
+                  for path in scalar_img_paths]
+    metrics = get_metric_names(scalar_img_paths, nr_volumes)
+    shape = (len(subjects), len(bundles), nr_points - 2, len(metrics))
+
+    # Reuse results of previous run if they were created with the same settings
+    cached = {}
+    if exists(cohort_file) and exists(cohort_file + ".json"):
+        results_old, meta_old = load_cohort(cohort_file)
+        if meta_old["bundles"] == bundles and meta_old["metrics"] == metrics and meta_old["nr_points"] == nr_points:
+            for idx, subject in enumerate(meta_old["subjects"]):
+                if meta_old["fingerprints"][idx] is not None:
+                    cached[subject] = (meta_old["fingerprints"][idx], np.array(results_old[idx]))
+        del results_old
+
+    results = np.lib.format.open_memmap(cohort_file + ".tmp.npy", mode="w+", dtype=np.float32, shape=shape)
+    meta = {"subjects": list(subjects), "bundles": list(bundles), "metrics": metrics, "nr_points": nr_points,
+            "fingerprints": [None] * len(subjects)}
+    subject_idxs = {subject: idx for idx, subject in enumerate(subjects)}
+
+    todo = []
+    for idx, subject in enumerate(subjects):
+        input_paths = _get_subject_paths(subject, tracking_dir, endings_dir, scalar_img_paths, bundles,
+                                         tracking_format)[3]
+        if subject in cached and cached[subject][0] == _get_input_fingerprint(input_paths):
+            meta["fingerprints"][idx] = cached[subject][0]
+            results[idx] = cached[subject][1]
+        else:
+            todo.append(subject)
+    results.flush()
+    del results
+    os.replace(cohort_file + ".tmp.npy", cohort_file)
+    _save_cohort_meta(cohort_file, meta)
+    print("Processing {} subjects ({} unchanged subjects loaded from {})".format(len(todo),
+                                                                                 len(subjects) - len(todo),
+                                                                                 cohort_file))
+
+    results = np.load(cohort_file, mmap_mode="r+")
+    if len(todo) == 0:
+        return results, meta
+    nr_cpus = psutil.cpu_count() if nr_cpus == -1 else nr_cpus
+    pool = multiprocessing.Pool(min(nr_cpus, len(todo)))
+    try:
+        tasks = [(subject, tracking_dir, endings_dir, scalar_img_paths, bundles, nr_points, dilation,
+                  tracking_format, min_nr_streamlines) for subject in todo]
+        for subject, fingerprint, subject_results in tqdm(pool.imap_unordered(_evaluate_cohort_subject_star, tasks),
+                                                         total=len(todo)):
+            idx = subject_idxs[subject]
+            results[idx] = subject_results
+            results.flush()
+            meta["fingerprints"][idx] = fingerprint
+            _save_cohort_meta(cohort_file, meta)
+    finally:
+        pool.close()
+        pool.join()
+    return results, meta
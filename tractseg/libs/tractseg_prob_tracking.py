@@ -2,7 +2,6 @@
 import psutil
 import numpy as np
 import multiprocessing
-from functools import partial
 
 from dipy.tracking.streamline import transform_streamlines
 from scipy.ndimage.morphology import binary_dilation
@@ -27,7 +26,7 @@ global _TRACKING_UNCERTAINTIES
 _TRACKING_UNCERTAINTIES = None
 
 
-def process_seedpoint(seed_point, spacing, next_step_displacement_std):
+def process_seedpoint(seed_point, spacing, next_step_displacement_std, seed_seq=None):
     """
     Create one streamline from one seed point.
 
@@ -35,6 +34,7 @@ def process_seedpoint(seed_point, spacing, next_step_displacement_std):
         seed_point: 3d point
         spacing: Only one value. Assumes isotropic images.
         next_step_displacement_std: stddev for gaussian distribution
+        seed_seq: np.random.SeedSequence for this seed point. If None the global np.random state is used.
     Returns:
         (streamline, streamline_length)
     """
@@ -43,7 +43,7 @@ def process_seedpoint(seed_point, spacing, next_step_displacement_std):
 
     # Has to be sub-method otherwise not working
     def process_one_way(peaks, streamline, max_nr_steps, step_size, probabilistic, next_step_displacement_std,
-                        max_tract_len, peak_len_thr, bundle_mask, tracking_uncertainties, reverse=False):
+                        max_tract_len, peak_len_thr, bundle_mask, tracking_uncertainties, rng, reverse=False):
         last_dir = None
         sl_len = 0
         for i in range(max_nr_steps):
@@ -70,7 +70,7 @@ def process_seedpoint(seed_point, spacing, next_step_displacement_std):
                     displacement_std_scaled = next_step_displacement_std * uncertainty
                 else:
                     displacement_std_scaled = next_step_displacement_std
-                displacement = np.random.normal(0, displacement_std_scaled, 3)
+                displacement = rng.normal(0, displacement_std_scaled, 3)
                 dir_scaled = dir_scaled + displacement
 
                 # If step_size too small and next_step_displacement_std too big: sometimes even goes back
@@ -146,22 +146,26 @@ def process_seedpoint(seed_point, spacing, next_step_displacement_std):
     global _TRACKING_UNCERTAINTIES
     tracking_uncertainties = _TRACKING_UNCERTAINTIES
 
+    # Each seed point has its own random stream. This way the result does not depend on which worker processes
+    # which seed point.
+    rng = np.random if seed_seq is None else np.random.default_rng(seed_seq)
+
     streamline1 = []
     if probabilistic:
-        random_seedpoint_displacement = np.random.normal(0, seedpoint_displacement_std, 3)
+        random_seedpoint_displacement = rng.normal(0, seedpoint_displacement_std, 3)
         seed_point = seed_point + random_seedpoint_displacement
     streamline1.append([seed_point[0], seed_point[1], seed_point[2]])  # add first point to streamline
     streamline2 = list(streamline1)  # deep copy
 
     streamline_part1, length_1 = process_one_way(peaks, streamline1, max_nr_steps, step_size, probabilistic,
                                                  next_step_displacement_std, max_tract_len, peak_len_thr, bundle_mask,
-                                                 tracking_uncertainties, reverse=False)
+                                                 tracking_uncertainties, rng, reverse=False)
 
     # Roughly doubles execution time but also roughly doubles number of resulting streamlines
     # Makes sense because many too short if seeding in middle of streamline.
     streamline_part2, length_2 = process_one_way(peaks, streamline2, max_nr_steps, step_size, probabilistic,
                                                  next_step_displacement_std, max_tract_len, peak_len_thr, bundle_mask,
-                                                 tracking_uncertainties, reverse=True)
+                                                 tracking_uncertainties, rng, reverse=True)
 
     if len(streamline_part2) > 0:
         # remove first element of part2 otherwise we have seed_point 2 times
@@ -182,19 +186,19 @@ def process_seedpoint(seed_point, spacing, next_step_displacement_std):
     return []
 
 
-def seed_generator(mask_coords, nr_seeds):
+def seed_generator(mask_coords, nr_seeds, rng=np.random):
     """
     Randomly select #nr_seeds voxels from mask.
     """
     nr_voxels = mask_coords.shape[0]
-    random_indices = np.random.choice(nr_voxels, nr_seeds, replace=True)
+    random_indices = rng.choice(nr_voxels, nr_seeds, replace=True)
     res = np.take(mask_coords, random_indices, axis=0)
     return res
 
 
 def track(peaks, max_nr_fibers=2000, smooth=None, compress=0.1, bundle_mask=None,
           start_mask=None, end_mask=None, tracking_uncertainties=None, dilation=0,
-          next_step_displacement_std=0.15, nr_cpus=-1, affine=None, spacing=None, verbose=True):
+          next_step_displacement_std=0.15, nr_cpus=-1, affine=None, spacing=None, seed=None, verbose=True):
     """
     Generate streamlines.
 
@@ -202,6 +206,10 @@ def track(peaks, max_nr_fibers=2000, smooth=None, compress=0.1, bundle_mask=None
     - only seeding in bundle_mask instead of entire image (seeding took very long)
     - calculating fiber length on the fly instead of using extra function which has to iterate over entire fiber a
     second time
+
+    If seed is not None the result is reproducible (independent of nr_cpus): Each batch of seeds gets its own
+    SeedSequence spawned from seed and each seed point in the batch gets its own stream spawned from the batch
+    SeedSequence.
     """
 
     peaks[:, :, :, 0] *= -1  # have to flip along x axis to work properly
@@ -237,18 +245,25 @@ def track(peaks, max_nr_fibers=2000, smooth=None, compress=0.1, bundle_mask=None
     else:
         nr_processes = nr_cpus
 
+    root_seed_seq = np.random.SeedSequence(seed)
+
     streamlines = []
     fiber_ctr = 0
     seed_ctr = 0
     # Processing seeds in batches so we can stop after we reached desired nr of streamlines. Not ideal. Could be
     #   optimised by more multiprocessing fanciness.
     while fiber_ctr < max_nr_fibers:
+        batch_seed_seq = root_seed_seq.spawn(1)[0]
+        batch_rng = np.random.default_rng(batch_seed_seq)
+        seeds = seed_generator(mask_coords, seeds_per_batch, rng=batch_rng)
+        seed_seqs = batch_seed_seq.spawn(seeds_per_batch)
+
         pool = multiprocessing.Pool(processes=nr_processes)
-        streamlines_tmp = pool.map(partial(process_seedpoint, next_step_displacement_std=next_step_displacement_std,
-                                           spacing=spacing),
-                                   seed_generator(mask_coords, seeds_per_batch))
-        # streamlines_tmp = [process_seedpoint(seed, spacing=spacing) for seed in
-        #                    seed_generator(mask_coords, seeds_per_batch)] # single threaded for debugging
+        streamlines_tmp = pool.starmap(process_seedpoint,
+                                       [(seed_point, spacing, next_step_displacement_std, seed_seq)
+                                        for seed_point, seed_seq in zip(seeds, seed_seqs)])
+        # streamlines_tmp = [process_seedpoint(seed_point, spacing, next_step_displacement_std, seed_seq)
+        #                    for seed_point, seed_seq in zip(seeds, seed_seqs)] # single threaded for debugging
         pool.close()
         pool.join()
 
@@ -277,7 +292,7 @@ def track(peaks, max_nr_fibers=2000, smooth=None, compress=0.1, bundle_mask=None
 
     # move streamlines to coordinate space
     #  This is doing: streamlines(coordinate_space) = affine * streamlines(voxel_space)
-    streamlines = list(transform_streamlines(streamlines, affine))
+    streamlines = transform_streamlines(streamlines, affine)
 
     # If the original image was not in MNI space we have to flip back to the original space
     # before saving the streamlines
@@ -287,9 +302,9 @@ def track(peaks, max_nr_fibers=2000, smooth=None, compress=0.1, bundle_mask=None
 
     # Smoothing does not change overall results at all because is just little smoothing. Just removes small unevenness.
     if smooth:
-        streamlines = fiber_utils.smooth_streamlines(streamlines, smoothing_factor=smooth)
+        streamlines = fiber_utils.smooth_streamlines(streamlines, smoothing_factor=smooth, nr_cpus=nr_cpus)
 
     if compress:
         streamlines = fiber_utils.compress_streamlines(streamlines, error_threshold=0.1, nr_cpus=nr_cpus)
 
-    return streamlines
+    return fiber_utils.as_streamlines(streamlines)
@@ -40,15 +40,18 @@ def _get_weights_for_this_epoch(Config, epoch_nr):
 
 def _update_metrics(calc_f1, experiment_type, metric_types, metrics, metr_batch, type):
     if calc_f1:
-        if experiment_type == "peak_regression":
-            peak_f1_mean = np.array([s.to('cpu') for s in list(metr_batch["f1_macro"].values())]).mean()
-            metr_batch["f1_macro"] = peak_f1_mean
+        if metr_batch["f1_macro"] is None:
+            # f1 was not calculated for this batch (TRAIN_METRICS_FREQ)
+            metric_types = [metric for metric in metric_types if metric != "f1_macro"]
 
-            metrics = metric_utils.add_to_metrics(metrics, metr_batch, type, metric_types)
+        elif experiment_type == "peak_regression":
+            peak_f1_mean = np.array(list(metr_batch["f1_macro"].values())).mean()
+            metr_batch["f1_macro"] = peak_f1_mean
 
         else:
             metr_batch["f1_macro"] = np.mean(metr_batch["f1_macro"])
-            metrics = metric_utils.add_to_metrics(metrics, metr_batch, type, metric_types)
+
+        metrics = metric_utils.add_to_metrics(metrics, metr_batch, type, metric_types)
 
     else:
         metrics = metric_utils.calculate_metrics_onlyLoss(metrics, metr_batch["loss"], type=type)
@@ -74,6 +77,9 @@ def train_model(Config, model, data_loader):
         for metric in Config.METRIC_TYPES:
             metrics[metric + "_" + type] = [0]
 
+    if Config.AUTO_AUGMENTATION_PROCESSES and Config.DIM == "2D":
+        data_loader.calibrate_num_processes(model, getattr(Config, "TRAIN_SUBJECTS"))
+
     batch_gen_train = data_loader.get_batch_generator(batch_size=Config.BATCH_SIZE, type="train",
                                                       subjects=getattr(Config, "TRAIN_SUBJECTS"))
     batch_gen_val = data_loader.get_batch_generator(batch_size=Config.BATCH_SIZE, type="validate",
@@ -84,6 +90,7 @@ def train_model(Config, model, data_loader):
 
         timings = defaultdict(lambda: 0)
         batch_nr = defaultdict(lambda: 0)
+        batch_nr_f1 = defaultdict(lambda: 0)
         weight_factor = _get_weights_for_this_epoch(Config, epoch_nr)
         types = ["validate"] if Config.ONLY_VAL else ["train", "validate"]
 
@@ -114,7 +121,9 @@ def train_model(Config, model, data_loader):
                 start_time_network = time.time()
                 if type == "train":
                     nr_of_updates += 1
-                    probs, metr_batch = model.train(x, y, weight_factor=weight_factor)
+                    calc_f1 = Config.CALC_F1 and batch_nr[type] % Config.TRAIN_METRICS_FREQ == 0
+                    probs, metr_batch = model.train(x, y, weight_factor=weight_factor,
+                                                    slice_dir=batch.get("slice_dir"), calc_f1=calc_f1)
                 elif type == "validate":
                     probs, metr_batch = model.test(x, y, weight_factor=weight_factor)
                 elif type == "test":
@@ -124,6 +133,8 @@ def train_model(Config, model, data_loader):
                 start_time_metrics = time.time()
                 metrics = _update_metrics(Config.CALC_F1, Config.EXPERIMENT_TYPE, Config.METRIC_TYPES,
                                           metrics, metr_batch, type)
+                if metr_batch["f1_macro"] is not None:
+                    batch_nr_f1[type] += 1
                 timings["metrics_time"] += time.time() - start_time_metrics
 
                 print_loss.append(metr_batch["loss"])
@@ -149,6 +160,9 @@ def train_model(Config, model, data_loader):
         # Average loss per batch over entire epoch
         metrics = metric_utils.normalize_last_element(metrics, batch_nr["train"], type="train")
         metrics = metric_utils.normalize_last_element(metrics, batch_nr["validate"], type="validate")
+        if Config.CALC_F1 and "f1_macro" in Config.METRIC_TYPES and batch_nr_f1["train"] > 0:
+            # f1 was only calculated for every TRAIN_METRICS_FREQ batch -> average over those batches
+            metrics["f1_macro_train"][-1] *= batch_nr["train"] / float(batch_nr_f1["train"])
 
         print("  Epoch {}, Average Epoch loss = {}".format(epoch_nr, metrics["loss_train"][-1]))
         exp_utils.print_and_save(Config.EXP_PATH, "  Epoch {}, nr_of_updates {}".format(epoch_nr, nr_of_updates))
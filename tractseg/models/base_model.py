@@ -25,6 +25,7 @@ except ImportError:
 from tractseg.libs import pytorch_utils
 from tractseg.libs import exp_utils
 from tractseg.libs import metric_utils
+from tractseg.data.torch_augmentation import TorchAugmentation
 
 
 class BaseModel:
@@ -95,6 +96,13 @@ class BaseModel:
             if not inference:
                 print("INFO: Did not find APEX, defaulting to fp32 training")
 
+        # Data augmentation on the batches after transfer to the GPU (instead of in the augmentation processes).
+        # Only implemented for 2D.
+        if not inference and self.Config.DAUG_TORCH and self.Config.DATA_AUGMENTATION and self.Config.DIM == "2D":
+            self.augmentation = TorchAugmentation(self.Config)
+        else:
+            self.augmentation = None
+
         if self.Config.LR_SCHEDULE:
             self.scheduler = lr_scheduler.ReduceLROnPlateau(self.optimizer,
                                                             mode=self.Config.LR_SCHEDULE_MODE,
@@ -111,9 +119,12 @@ class BaseModel:
         #                                 stride=1, padding=0, bias=True).to(self.device)
 
 
-    def train(self, X, y, weight_factor=None):
-        X = X.contiguous().cuda(non_blocking=True)  # (bs, features, x, y)
-        y = y.contiguous().cuda(non_blocking=True)  # (bs, classes, x, y)
+    def train(self, X, y, weight_factor=None, slice_dir=None, calc_f1=True):
+        X = X.contiguous().to(self.device, non_blocking=True)  # (bs, features, x, y)
+        y = y.contiguous().to(self.device, non_blocking=True)  # (bs, classes, x, y)
+
+        if self.augmentation is not None:
+            X, y = self.augmentation(X, y, slice_dir=slice_dir)
 
         self.net.train()
         self.optimizer.zero_grad()
@@ -123,10 +134,10 @@ class BaseModel:
         if weight_factor is not None:
             if len(y.shape) == 4:  # 2D
                 weights = torch.ones((self.Config.BATCH_SIZE, self.Config.NR_OF_CLASSES,
-                                      y.shape[2], y.shape[3])).cuda()
+                                      y.shape[2], y.shape[3])).to(self.device)
             else:  # 3D
                 weights = torch.ones((self.Config.BATCH_SIZE, self.Config.NR_OF_CLASSES,
-                                      y.shape[2], y.shape[3], y.shape[4])).cuda()
+                                      y.shape[2], y.shape[3], y.shape[4])).to(self.device)
             bundle_mask = y > 0
             weights[bundle_mask.data] *= weight_factor  # 10
 
@@ -148,7 +159,9 @@ class BaseModel:
             loss.backward()
         self.optimizer.step()
 
-        if self.Config.EXPERIMENT_TYPE == "peak_regression":
+        if not calc_f1:
+            f1 = None
+        elif self.Config.EXPERIMENT_TYPE == "peak_regression":
             f1 = metric_utils.calc_peak_length_dice_pytorch(self.Config.CLASSES, outputs.detach(), y.detach(),
                                                             max_angle_error=self.Config.PEAK_DICE_THR,
                                                             max_length_error=self.Config.PEAK_DICE_LEN_THR)
@@ -174,8 +187,8 @@ class BaseModel:
 
     def test(self, X, y, weight_factor=None):
         with torch.no_grad():
-            X = X.contiguous().cuda(non_blocking=True)
-            y = y.contiguous().cuda(non_blocking=True)
+            X = X.contiguous().to(self.device, non_blocking=True)
+            y = y.contiguous().to(self.device, non_blocking=True)
 
         if self.Config.DROPOUT_SAMPLING:
             self.net.train()
@@ -187,10 +200,10 @@ class BaseModel:
         if weight_factor is not None:
             if len(y.shape) == 4:  # 2D
                 weights = torch.ones((self.Config.BATCH_SIZE, self.Config.NR_OF_CLASSES,
-                                      y.shape[2], y.shape[3])).cuda()
+                                      y.shape[2], y.shape[3])).to(self.device)
             else:  # 3D
                 weights = torch.ones((self.Config.BATCH_SIZE, self.Config.NR_OF_CLASSES,
-                                      y.shape[2], y.shape[3], y.shape[4])).cuda()
+                                      y.shape[2], y.shape[3], y.shape[4])).to(self.device)
             bundle_mask = y > 0
             weights[bundle_mask.data] *= weight_factor
             if self.Config.EXPERIMENT_TYPE == "peak_regression":